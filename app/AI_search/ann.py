@@ -0,0 +1,181 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import io
+import math
+import time
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+
+from .retrieval import top_k
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 8192) -> np.ndarray:
+    """Index of the most similar centroid for every unit vector, computed in blocks to bound memory"""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start : start + block_size].astype(np.float32)
+        assignments[start : start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 10, seed: int = 0) -> np.ndarray:
+    """Cluster unit vectors on cosine similarity and return the unit-length centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].astype(np.float32)
+    vectors = vectors.astype(np.float32)
+    for _ in range(n_iter):
+        assignments = _assign(vectors, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[counts > 0] = np.add.reduceat(vectors[np.argsort(assignments, kind="stable")], starts[counts > 0], axis=0)
+        norms = np.linalg.norm(sums, axis=1)
+        empty = norms == 0
+        # Empty clusters are restarted on random vectors, so no centroid is wasted
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        norms[empty] = 1
+        centroids = sums / norms[:, None]
+    return centroids
+
+
+class IVFIndex:
+    """Inverted file index: the vectors are partitioned by their closest k-means centroid, so a query only has to be
+    scored against the vectors in the few partitions (lists) whose centroids are closest to it.
+
+    A segment with an IVF index stores its rows in the order of the lists, so every list is a contiguous range of rows
+    given by an offset table. list_rows holds the row each stored row had before it was put in list order.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @classmethod
+    def train(
+        cls, normalized: np.ndarray, n_lists: int = None, n_iter: int = 10, samples_per_list: int = 64, seed: int = 0
+    ) -> "IVFIndex":
+        """Train the coarse quantizer on a sample of the unit vectors and assign all vectors to their list"""
+        n_lists = n_lists or max(int(np.sqrt(len(normalized))), 1)
+        rng = np.random.default_rng(seed)
+        n_samples = min(len(normalized), n_lists * samples_per_list)
+        sample = normalized[np.sort(rng.choice(len(normalized), n_samples, replace=False))]
+        centroids = spherical_kmeans(sample, n_lists, n_iter=n_iter, seed=seed)
+        return cls.from_assignments(centroids, _assign(normalized, centroids))
+
+    @classmethod
+    def from_assignments(cls, centroids: np.ndarray, assignments: np.ndarray) -> "IVFIndex":
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=len(centroids)))
+        return cls(centroids, list_offsets, order.astype(np.int64))
+
+    def probe(self, query: np.ndarray, nprobe: int) -> list[tuple[int, int]]:
+        """Row ranges of the nprobe lists whose centroids are most similar to the query, in the order of the lists, so
+        neighbouring lists are read as one range
+        """
+        lists, _ = top_k(-(self.centroids @ query), nprobe)
+        ranges = []
+        for i in np.sort(lists):
+            start, stop = int(self.list_offsets[i]), int(self.list_offsets[i + 1])
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop)
+            elif stop > start:
+                ranges.append((start, stop))
+        return ranges
+
+    def remap(self, live_rows: Optional[np.ndarray], offset: int) -> "IVFIndex":
+        """Translate the list ranges of a segment to the rows of the loaded project index, dropping the tombstoned rows.
+        live_rows are the stored rows of the segment that are not tombstoned.
+        """
+        if live_rows is None:
+            return IVFIndex(self.centroids, self.list_offsets + offset, self.list_rows)
+        list_offsets = np.searchsorted(live_rows, self.list_offsets) + offset
+        return IVFIndex(self.centroids, list_offsets, self.list_rows[live_rows])
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez(buffer, centroids=self.centroids, list_offsets=self.list_offsets, list_rows=self.list_rows)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "IVFIndex":
+        arrays = np.load(io.BytesIO(data), allow_pickle=False)
+        return cls(arrays["centroids"], arrays["list_offsets"], arrays["list_rows"])
+
+
+class ANNSearcher:
+    """Approximate search over a project index that consists of several segments. Segments with an IVF index are
+    probed, the rows of the other (small) segments are always scored exactly.
+
+    The rows of every IVF index are stored in the order of its lists, so probing a list scores a contiguous slice of
+    the (memory-mapped) embeddings without copying them.
+    """
+
+    def __init__(self, ivf_indexes: Sequence[IVFIndex], exact_rows: np.ndarray, normalized: np.ndarray):
+        self.ivf_indexes = list(ivf_indexes)
+        self.exact_rows = exact_rows
+        self.normalized = normalized
+
+    @property
+    def nbytes(self) -> int:
+        return self.exact_rows.nbytes + sum(
+            ivf.centroids.nbytes + ivf.list_offsets.nbytes + ivf.list_rows.nbytes for ivf in self.ivf_indexes
+        )
+
+    def search(self, query: Sequence[float], k: int, probe_fraction: float) -> tuple[np.ndarray, np.ndarray]:
+        """Rows and cosine distances of the k closest chunks among the probed lists and the exactly scored rows. The
+        given fraction of the lists of every IVF index is probed, at least one list.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        rows = []
+        similarities = []
+        for ivf in self.ivf_indexes:
+            for start, stop in ivf.probe(query, max(math.ceil(probe_fraction * len(ivf.centroids)), 1)):
+                rows.append(np.arange(start, stop))
+                similarities.append(self.normalized[start:stop].astype(np.float32, copy=False) @ query)
+        if len(self.exact_rows):
+            rows.append(self.exact_rows)
+            similarities.append(self.normalized[self.exact_rows].astype(np.float32) @ query)
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        best, distances = top_k(1 - np.concatenate(similarities), k)
+        return np.concatenate(rows)[best], distances
+
+
+def recall_report(index, queries: np.ndarray, k: int, probe_fractions: Sequence[float]) -> list[dict]:
+    """Compare approximate search at several probe fractions against exact search on the same index. Returns the mean
+    recall@k and the mean latency per query, in milliseconds, for exact search (probe fraction None) and for every
+    probe fraction.
+    """
+    exact = []
+    start = time.perf_counter()
+    for query in queries:
+        exact.append(set(index.engine.search(query, k)[0].tolist()))
+    report = [
+        {"probe_fraction": None, "recall": 1.0, "latency_ms": 1000 * (time.perf_counter() - start) / len(queries)}
+    ]
+    for probe_fraction in probe_fractions:
+        hits = 0
+        start = time.perf_counter()
+        for query, expected in zip(queries, exact):
+            hits += len(expected & set(index.search(query, k, probe_fraction=probe_fraction)[0].tolist()))
+        latency = 1000 * (time.perf_counter() - start) / len(queries)
+        report.append({"probe_fraction": probe_fraction, "recall": hits / (k * len(queries)), "latency_ms": latency})
+    return report
@@ -0,0 +1,221 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import hashlib
+import io
+import json
+import re
+import time
+from typing import Hashable
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+from viktor.core import File
+from viktor.core import Storage
+
+from .config import ANSWER_CACHE_MAX_ENTRIES
+from .config import ANSWER_CACHE_SIMILARITY
+from .config import ANSWER_CACHE_TTL
+
+ANSWER_CACHE_KEY = "answer_cache"
+
+# Every answer is stored under its own key. The catalogue lists the stored answers with what the semantic tier matches
+# on, the embeddings of their questions are kept in a separate float16 array that is only read for that tier.
+ANSWER_CACHE_CATALOGUE_KEY = "answer_cache_catalogue"
+ANSWER_CACHE_EMBEDDINGS_KEY = "answer_cache_embeddings"
+
+
+def normalize_question(question: str) -> str:
+    """Lower case the question and drop the whitespace and punctuation that do not change its meaning"""
+    return re.sub(r"\s+", " ", question).strip(" ?!.").lower()
+
+
+class AnswerCache:
+    """Answers to earlier questions on a project, stored in the entity storage of the project.
+
+    An answer is reused when the same question, after normalization, is asked again on the same version of the project
+    index and with the same search filter, given as scope. When a similarity threshold is set, an answer is also reused
+    for a question whose embedding is at least that similar, as long as the same chunks were retrieved for it and the
+    answer is in the same language. The answers keep the rows of the index their context was built from instead of the
+    texts. Answers expire after the time to live and the oldest answers are evicted when the cache is full, so reusing
+    an answer does not write to storage.
+    """
+
+    def __init__(
+        self,
+        index_version: Hashable,
+        ttl: float = ANSWER_CACHE_TTL,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        similarity: Optional[float] = ANSWER_CACHE_SIMILARITY,
+        scope: str = "",
+    ):
+        self.index_version = index_version
+        self.scope = scope
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self._catalogue = None
+        self._embeddings = None
+        self._pending = {}
+        self._evicted = set()
+
+    def _key(self, question: str) -> str:
+        normalized = json.dumps([self.index_version, self.scope, normalize_question(question)])
+        return f"{ANSWER_CACHE_KEY}_{hashlib.sha256(normalized.encode()).hexdigest()[:32]}"
+
+    def _entry(self, key: str) -> Optional[dict]:
+        entry = self._pending.get(key)
+        if entry is None:
+            try:
+                entry = json.loads(Storage().get(key, scope="entity").getvalue())
+            except FileNotFoundError:
+                return None
+        return entry if entry["created"] > time.time() - self.ttl else None
+
+    @property
+    def catalogue(self) -> list[dict]:
+        """Stored answers, oldest first, loaded from storage on first use"""
+        if self._catalogue is None:
+            try:
+                self._catalogue = json.loads(Storage().get(ANSWER_CACHE_CATALOGUE_KEY, scope="entity").getvalue())
+            except FileNotFoundError:
+                self._catalogue = []
+        return self._catalogue
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """Question embeddings of the catalogue, loaded from storage on first use"""
+        if self._embeddings is None:
+            try:
+                data = Storage().get(ANSWER_CACHE_EMBEDDINGS_KEY, scope="entity").getvalue_binary()
+                self._embeddings = np.load(io.BytesIO(data), allow_pickle=False)
+            except FileNotFoundError:
+                self._embeddings = np.zeros((0, 0), dtype=np.float16)
+        return self._embeddings
+
+    def lookup(self, question: str) -> Optional[dict]:
+        """Cached answer to the same question, as a dictionary with the keys 'answer' and 'rows'"""
+        return self._entry(self._key(question))
+
+    def lookup_similar(
+        self, question_embedding: Sequence[float], rows: Sequence[int], language_instruction: str
+    ) -> Optional[dict]:
+        """Cached answer to the most similar question with the same context rows and language, when it is similar
+        enough. Questions that were answered without embedding them are only found by lookup.
+        """
+        if self.similarity is None or question_embedding is None:
+            return None
+        expiry = time.time() - self.ttl
+        rows = list(map(int, rows))
+        candidates = [
+            item
+            for item in self.catalogue
+            if item["index_version"] == self.index_version
+            and item["scope"] == self.scope
+            and item["created"] > expiry
+            and item["rows"] == rows
+            and item["language_instruction"] == language_instruction
+            and item["embedding"] is not None
+            and item["embedding"] < len(self.embeddings)
+        ]
+        if not candidates:
+            return None
+        query = np.asarray(question_embedding, dtype=np.float32)
+        embeddings = self.embeddings[[item["embedding"] for item in candidates]].astype(np.float32)
+        if embeddings.shape[1] != len(query):
+            return None
+        similarities = embeddings @ query / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query))
+        best = int(np.argmax(similarities))
+        return self._entry(candidates[best]["key"]) if similarities[best] >= self.similarity else None
+
+    def store(
+        self,
+        question: str,
+        question_embedding: Optional[Sequence[float]],
+        language_instruction: str,
+        answer: str,
+        rows: Sequence[int],
+    ):
+        """Add an answer to the cache, with the rows of the index its context was built from. The answer is written to
+        storage by save.
+        """
+        key = self._key(question)
+        now = time.time()
+        rows = list(map(int, rows))
+        self._pending[key] = {"created": now, "answer": answer, "rows": rows}
+        self._evicted.discard(key)
+        embedding = None
+        if question_embedding is not None:
+            vector = np.asarray(question_embedding, dtype=np.float16)[np.newaxis]
+            if len(self.embeddings) and self.embeddings.shape[1] == vector.shape[1]:
+                self._embeddings = np.vstack([self.embeddings, vector])
+            else:
+                # The first embedding, or the embeddings model was changed: the earlier embeddings can not be compared
+                self._embeddings = vector
+                for item in self.catalogue:
+                    item["embedding"] = None
+            embedding = len(self._embeddings) - 1
+        self._catalogue = [item for item in self.catalogue if item["key"] != key]
+        self._catalogue.append(
+            {
+                "key": key,
+                "index_version": self.index_version,
+                "scope": self.scope,
+                "created": now,
+                "rows": rows,
+                "language_instruction": language_instruction,
+                "embedding": embedding,
+            }
+        )
+
+        # Answers on another version of the index can not be reused anymore
+        expiry = now - self.ttl
+        kept = [
+            item for item in self._catalogue if item["index_version"] == self.index_version and item["created"] > expiry
+        ]
+        kept = kept[max(len(kept) - self.max_entries, 0) :]
+        kept_keys = {item["key"] for item in kept}
+        self._evicted.update(item["key"] for item in self._catalogue if item["key"] not in kept_keys)
+        self._catalogue = kept
+
+    def save(self):
+        """Write the stored answers to storage, together with the catalogue and the embeddings of the questions, and
+        delete the evicted answers
+        """
+        if not self._pending and not self._evicted:
+            return
+        storage = Storage()
+        for key, entry in self._pending.items():
+            if key not in self._evicted:
+                storage.set(key, File.from_data(json.dumps(entry)), scope="entity")
+        for key in self._evicted - self._pending.keys():
+            try:
+                storage.delete(key, scope="entity")
+            except FileNotFoundError:
+                pass
+
+        # Only keep the embeddings of the answers in the catalogue
+        embedded = [item for item in self.catalogue if item["embedding"] is not None]
+        embeddings = self.embeddings[[item["embedding"] for item in embedded]] if embedded else self.embeddings[:0]
+        for position, item in enumerate(embedded):
+            item["embedding"] = position
+        self._embeddings = embeddings
+        buffer = io.BytesIO()
+        np.save(buffer, embeddings, allow_pickle=False)
+        storage.set(ANSWER_CACHE_EMBEDDINGS_KEY, File.from_data(buffer.getvalue()), scope="entity")
+        storage.set(ANSWER_CACHE_CATALOGUE_KEY, File.from_data(json.dumps(self.catalogue)), scope="entity")
+        self._pending = {}
+        self._evicted = set()
@@ -0,0 +1,169 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import csv
+import io
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from viktor import UserError
+from viktor.core import File
+from viktor.core import progress_message
+
+from .answer_cache import AnswerCache
+from .config import BATCH_MAX_QUESTIONS
+from .config import COMPLETIONS_CONCURRENCY
+from .config import COMPLETIONS_MODEL
+from .config import HYBRID_RRF_K
+from .config import HYBRID_SEARCH
+from .config import N_CONTEXT
+from .config import N_CONTEXT_CANDIDATES
+from .context import build_context
+from .context import context_from_rows
+from .context import get_prompt
+from .helper_functions import BatchEmbedder
+from .helper_functions import completions_rate_limiter
+from .helper_functions import count_tokens
+from .helper_functions import get_chat_completion_gpt
+from .helper_functions import get_client
+from .helper_functions import get_response_message
+from .index_storage import ChunkIndex
+from .language import language_instruction
+from .lexical import fuse_rankings
+
+logger = logging.getLogger(__name__)
+
+
+def parse_questions(text: str) -> list[str]:
+    """One question per non-empty line, without repeated questions"""
+    questions = list(dict.fromkeys(line.strip() for line in (text or "").splitlines() if line.strip()))
+    if not questions:
+        raise UserError("Please enter at least one question, one question per line")
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise UserError(f"Please enter at most {BATCH_MAX_QUESTIONS} questions at once")
+    return questions
+
+
+class BatchAssistant:
+    """Answers a list of questions about the documents of a project in one job.
+
+    All questions are embedded in batched requests and scored against the index at once. The completions are then
+    requested concurrently, under the rate limit of the completions deployment. Answers that are in the answer cache
+    are reused.
+    """
+
+    def __init__(
+        self,
+        questions: list[str],
+        index: ChunkIndex,
+        answer_cache: AnswerCache = None,
+        max_workers: int = None,
+        rows: np.ndarray = None,
+    ):
+        self.questions = questions
+        self.index = index
+        self.rows = rows
+        self.answer_cache = answer_cache
+        self.max_workers = max_workers or COMPLETIONS_CONCURRENCY
+        self.client = get_client()
+
+    def answer_all(self) -> list[dict]:
+        """Answer all questions. Returns a dictionary per question, in the order of the questions, with the keys
+        'question', 'answer', 'metadata' and 'context'.
+        """
+        start = time.perf_counter()
+        results = [{"question": question} for question in self.questions]
+        pending = []
+        for result in results:
+            cached = self.answer_cache.lookup(result["question"]) if self.answer_cache is not None else None
+            if cached is None:
+                pending.append(result)
+            else:
+                _, result["metadata"], result["context"] = context_from_rows(self.index, cached["rows"])
+                result["answer"] = cached["answer"]
+
+        if pending:
+            progress_message(f"Embedding {len(pending)} questions")
+            embeddings = BatchEmbedder(self.client).embed([result["question"] for result in pending])
+            candidates, _ = self.index.search_many(embeddings, max(N_CONTEXT, N_CONTEXT_CANDIDATES), self.rows)
+            to_complete = []
+            for result, embedding, rows in zip(pending, embeddings, candidates):
+                if HYBRID_SEARCH and self.index.lexical is not None:
+                    lexical_rows, _ = self.index.lexical.search(
+                        result["question"], max(N_CONTEXT, N_CONTEXT_CANDIDATES), self.rows
+                    )
+                    rows = fuse_rankings([rows, lexical_rows], HYBRID_RRF_K) if len(lexical_rows) else rows
+                context, result["metadata"], result["context"], selected = build_context(self.index, rows, N_CONTEXT)
+                instruction = language_instruction(result["question"])
+                cached = None
+                if self.answer_cache is not None:
+                    cached = self.answer_cache.lookup_similar(embedding, selected, instruction)
+                if cached is not None:
+                    result["answer"] = cached["answer"]
+                else:
+                    to_complete.append((result, embedding, instruction, context, selected))
+
+            progress_message(f"Answering {len(to_complete)} questions")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [
+                    executor.submit(self._complete, result["question"], context, instruction)
+                    for result, _, instruction, context, _ in to_complete
+                ]
+                for (result, embedding, instruction, _, selected), future in zip(to_complete, futures):
+                    result["answer"] = answer = future.result()
+                    if self.answer_cache is not None:
+                        self.answer_cache.store(
+                            result["question"],
+                            embedding,
+                            instruction,
+                            answer,
+                            selected,
+                        )
+            if self.answer_cache is not None and to_complete:
+                self.answer_cache.save()
+        logger.info(
+            "Answered %d questions (%d from the cache) in %.1f s",
+            len(results),
+            len(results) - len(pending),
+            time.perf_counter() - start,
+        )
+        return results
+
+    def _complete(self, question: str, context: str, language_instruction: str) -> str:
+        messages = get_prompt({"role": "user", "content": question}, context, language_instruction)
+        completions_rate_limiter.acquire(
+            sum(count_tokens(message["content"], COMPLETIONS_MODEL) for message in messages)
+        )
+        return get_response_message(get_chat_completion_gpt(self.client, messages))
+
+
+def format_sources(metadata_list: list[dict]) -> str:
+    return "; ".join(
+        f"{source['source']} (page {source['page_number']})"
+        for metadata in metadata_list
+        for source in [metadata, *metadata.get("occurrences", [])]
+    )
+
+
+def batch_report_csv(results: list[dict]) -> File:
+    """Report of the answers with their sources, as a CSV file that can be opened in a spreadsheet"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["Question", "Answer", "Sources"])
+    for result in results:
+        writer.writerow([result["question"], result["answer"], format_sources(result["metadata"])])
+    return File.from_data(buffer.getvalue().encode("utf-8-sig"))
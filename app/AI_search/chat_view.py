@@ -12,8 +12,27 @@ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFT
 SOFTWARE.
 """
 
+from html import escape as html_escape
+
 import markdown
 
+from .tracing import Trace
+
+
+def source_statement(metadata: dict) -> str:
+    """Page and document of a source, followed by the other places where the same text occurs"""
+    statement = f"Page {metadata['page_number']} - Document {metadata['source']}"
+    if "project" in metadata:
+        statement += f" - Project {metadata['project']}"
+    occurrences = metadata.get("occurrences", [])
+    if occurrences:
+        statement += ", also on " + ", ".join(
+            f"page {occurrence['page_number']} of {occurrence['source']}"
+            + (f" ({occurrence['project']})" if "project" in occurrence else "")
+            for occurrence in occurrences
+        )
+    return statement
+
 
 def list_to_html_string(input_list: list[str]):
     """Convert sources to nice-looking html"""
@@ -29,8 +48,12 @@ def list_to_html_string(input_list: list[str]):
     return html_string
 
 
-def generate_html_code(question: str, answer: str, metadata: list[dict], context_history: list[str]):
-    """Present the results in a nice-looking html"""
+def generate_html_code(
+    question: str, answer: str, metadata: list[dict], context_history: list[str], timings: Trace = None
+):
+    """Present the results in a nice-looking html. When the trace of answering the question is given, the duration of
+    every stage is shown in a collapsed panel below the sources.
+    """
     html = """
     <!DOCTYPE html>
     <html>
@@ -102,12 +125,14 @@ def generate_html_code(question: str, answer: str, metadata: list[dict], context
     content = markdown.markdown(statement)
     html += f'<div class="message">{content}</div>\n'
     for context, metadata_source in zip(context_history, metadata):
-        statement = f"Page {metadata_source['page_number']} - Document {metadata_source['source']}"
+        statement = source_statement(metadata_source)
         content = markdown.markdown(context)
         html += '<details class="message"> <summary>{}</summary> <div class="content">{}</div> </details>\n'.format(
             statement, content
         )
     html += "</blockquote>"
+    if timings is not None:
+        html += timings_html(timings)
 
     html += """
         </div>
@@ -118,3 +143,72 @@ def generate_html_code(question: str, answer: str, metadata: list[dict], context
     </html>
     """
     return html
+
+
+def timings_html(timings: Trace) -> str:
+    """Collapsible table with the duration and the counters of every stage of a trace"""
+    rows = ""
+    for stage, entry in timings.stages.items():
+        counters = ", ".join(f"{key.replace('_', ' ')}: {value}" for key, value in entry.items() if key != "seconds")
+        rows += f"<tr><td>{html_escape(stage)}</td><td>{entry['seconds']:.3f} s</td><td>{counters}</td></tr>\n"
+    return (
+        f'<details class="message"> <summary>Timings ({timings.seconds:.2f} s in total)</summary> '
+        f'<div class="content"><table>{rows}</table></div> </details>\n'
+    )
+
+
+def generate_batch_html(results: list[dict]):
+    """Present the answers to a batch of questions as a single table, with the sources of every answer"""
+    html = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>Batch answers</title>
+        <style>
+            body{
+                font-family: "Roboto","Helvetica","Arial", sans-serif;
+                font-size: 0.875rem;
+                line-height: 1.43;
+                letter-spacing: 0.01071em;
+                color: #4e4b66;
+            }
+
+            table {
+                border-collapse: collapse;
+                width: 100%;
+            }
+
+            th, td {
+                border: 1px solid #ccc;
+                padding: 10px;
+                text-align: left;
+                vertical-align: top;
+            }
+
+            th {
+                background: #F7F7FC;
+            }
+
+            .question {
+                font-weight: bold;
+                font-style: italic;
+            }
+        </style>
+    </head>
+    <body>
+        <table>
+            <tr><th>#</th><th>Question</th><th>Answer</th><th>Sources</th></tr>
+    """
+    for number, result in enumerate(results, start=1):
+        sources = "<br>".join(html_escape(source_statement(metadata)) for metadata in result["metadata"])
+        html += (
+            f'<tr><td>{number}</td><td class="question">{html_escape(result["question"])}</td>'
+            f'<td>{markdown.markdown(result["answer"])}</td><td>{sources}</td></tr>\n'
+        )
+    html += """
+        </table>
+    </body>
+    </html>
+    """
+    return html
@@ -1,6 +1,56 @@
 COMPLETIONS_MODEL = "gpt-35-turbo"
 EMBEDDINGS_MODEL = "text-embedding-ada-002"
+EMBEDDINGS_MAX_BATCH_SIZE = 16  # Maximum number of inputs per embeddings request accepted by AzureAI
+EMBEDDINGS_MAX_BATCH_TOKENS = 8191  # Maximum number of tokens that are sent in a single embeddings request
 TEMPERATURE = 0
-MAX_RETRIES = 20
-N_CONTEXT = 5
+MAX_RETRIES = 3
+HTTP_MAX_CONNECTIONS = 32  # Connections to the AzureAI endpoint that are open at once, over all threads of the process
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16  # Idle connections that are kept alive for the next requests
+HTTP_KEEPALIVE_EXPIRY = 60  # Seconds that an idle connection is kept alive
+HTTP_TIMEOUT = 60  # Seconds to wait for a response of AzureAI
+HTTP_CONNECT_TIMEOUT = 5
+EMBEDDINGS_REQUESTS_PER_MINUTE = 720  # Quota of the embeddings deployment in AzureAI, shared by all concurrent uploads
+EMBEDDINGS_TOKENS_PER_MINUTE = 120_000
+MAX_THROTTLED_RETRIES = 10  # Retries of a throttled embeddings request, each after the wait time asked by AzureAI
+EMBEDDINGS_CONCURRENCY = 4  # Number of embeddings requests that are kept in flight during the processing of a PDF
+EMBEDDING_CACHE_MAX_ENTRIES = 20_000  # Chunk embeddings kept in the workspace cache, about 6 kB each for ada-002
+EMBEDDING_CACHE_PACK_SIZE = 64  # Embeddings stored together in one file of the cache, in the order they were added
+EMBEDDING_CACHE_CONCURRENCY = 8  # Files of the cache that are downloaded at the same time
+N_CONTEXT = 5  # Maximum number of chunks in the context of a question
+N_CONTEXT_CANDIDATES = 20  # Closest chunks considered for the context, before duplicates and the token budget apply
+CONTEXT_TOKEN_BUDGETS = {  # Tokens available for the context in the prompt, per completions model
+    "gpt-35-turbo": 2500,
+    "gpt-35-turbo-16k": 12000,
+    "gpt-4": 6000,
+    "gpt-4-32k": 24000,
+    "gpt-4-turbo": 24000,
+}
+CONTEXT_DUPLICATE_SIMILARITY = 0.97  # Chunks at least this similar to a chunk already in the context are left out
+CHUNK_SIZE = 1500  # Maximum number of characters per chunk when splitting the PDF text
+CHUNK_OVERLAP = 150  # Number of characters that consecutive chunks of a page share
+PDF_EXTRACTION_WORKERS = 4  # Worker processes extracting the text of large PDFs
+PDF_PAGES_PER_TASK = 16  # Pages extracted per task, the chunks of a task are embedded while the next tasks run
+INGEST_CHECKPOINT_CHUNKS = 200  # Embedded chunks are saved in batches of this size, so a failed upload can resume
+ANSWER_CACHE_TTL = 7 * 24 * 3600  # Seconds that answers are reused for the same question on the same project index
+ANSWER_CACHE_MAX_ENTRIES = 200  # Answers kept per project, the oldest are evicted
+ANSWER_CACHE_SIMILARITY = 0.97  # Answers are reused for questions this similar with the same sources, None disables
+COMPLETIONS_REQUESTS_PER_MINUTE = 120  # Quota of the completions deployment in AzureAI
+COMPLETIONS_TOKENS_PER_MINUTE = 60_000
+COMPLETIONS_CONCURRENCY = 4  # Number of completions that are kept in flight when answering a batch of questions
+BATCH_MAX_QUESTIONS = 250
+FEDERATED_MAX_WORKERS = 8  # Number of project indexes that are loaded and searched at once by the folder conversation
+SHOW_TIMINGS = False  # Show the duration of every stage of answering a question in a panel below the answer
 SYSTEM_MESSAGE = """You are a helpful assistant and answer the questions, based on the provided context."""
+INDEX_DTYPE = "float32"  # "float32" | "float16", precision of the embeddings in the stored project index
+TEXT_BLOCK_CHUNKS = 64  # Chunk texts are compressed in blocks of this many chunks, only read blocks are inflated
+INDEX_QUANTIZATION = None  # None | "int8", int8 codes that are scanned first, to search large indexes faster
+INDEX_RESCORE_FACTOR = 4  # With int8 codes, rescore this many times k candidates with the full-precision embeddings
+INDEX_MAX_SEGMENTS = 8  # The project index is compacted into a single segment when it has more segments than this
+INDEX_MAX_TOMBSTONE_FRACTION = 0.25  # ... or when a larger fraction of its rows belongs to removed documents
+INDEX_DEDUPLICATION = True  # Store chunks that occur in several places once, citing all the places they occur
+INDEX_DUPLICATE_SIMILARITY = 0.98  # Chunks whose embeddings are at least this similar count as duplicates
+ANN_MIN_CHUNKS = 20_000  # Segments with at least this many chunks get an IVF index for approximate search
+ANN_PROBE_FRACTION = 0.05  # Fraction of the IVF lists scanned per query, a recall@20 of 1.0 in ann_recall
+HYBRID_SEARCH = True  # Fuse the ranking of the BM25 keyword index with the embedding ranking of the chunks
+HYBRID_RRF_K = 60  # Rank offset of reciprocal rank fusion, higher values weigh the lower ranks more evenly
+INDEX_CACHE_MAX_BYTES = 512 * 1024**2  # Memory budget for the project indexes kept loaded between questions
@@ -13,40 +13,36 @@ SOFTWARE.
 """
 
 from typing import List
+from typing import Sequence
 
+import numpy as np
 from openai import OpenAI
-from scipy import spatial
 from viktor import progress_message
 
+from .config import CHUNK_OVERLAP
+from .config import COMPLETIONS_MODEL
+from .config import CONTEXT_DUPLICATE_SIMILARITY
+from .config import CONTEXT_TOKEN_BUDGETS
+from .config import HYBRID_RRF_K
+from .config import HYBRID_SEARCH
+from .config import N_CONTEXT_CANDIDATES
+from .config import SYSTEM_MESSAGE
+from .helper_functions import count_tokens
 from .helper_functions import get_embedding
+from .index_storage import ChunkIndex
+from .lexical import fuse_rankings
+from .lexical import identifier_query
+from .retrieval import RetrievalEngine
+from .tracing import stage
 
 
 def distances_from_embeddings(
     query_embedding: List[float],
     embeddings: List[List[float]],
     distance_metric="cosine",
-) -> List[List]:
+) -> np.ndarray:
     """Return the distances between a query embedding and a list of embeddings."""
-    distance_metrics = {
-        "cosine": spatial.distance.cosine,
-        "L1": spatial.distance.cityblock,
-        "L2": spatial.distance.euclidean,
-        "Linf": spatial.distance.chebyshev,
-    }
-    distances = [distance_metrics[distance_metric](query_embedding, embedding) for embedding in embeddings]
-    return distances
-
-
-def get_question_for_language(current_question: str) -> list[dict]:
-    """Retrieves the language from the question and returns it as an instruction."""
-    return [
-        {
-            "role": "user",
-            "content": f"What language is the following text? Answer in a single word "
-            f"{current_question}. Provide your answer as an instruction, "
-            f"such as: 'Answer in Dutch', 'Answer in English'",
-        }
-    ]
+    return RetrievalEngine.from_embeddings(embeddings).distances(query_embedding, distance_metric)
 
 
 def get_question_with_context(current_question: dict, context: str):
@@ -61,24 +57,125 @@ def get_question_with_context(current_question: dict, context: str):
     return question_with_context
 
 
-def create_context(client: OpenAI, current_question: str, df, context_number):
-    """Create a context for a question by finding the most similar context from the dataframe"""
+def get_prompt(current_question: dict, context: str, language_instruction: str) -> list[dict]:
+    """The messages sent to the completions model to answer a question with its context"""
+    questions_and_answers = [get_question_with_context(current_question, context)]
+
+    # Insert at the end to make it more accurate
+    questions_and_answers.append({"role": "system", "content": SYSTEM_MESSAGE + language_instruction})
+    return questions_and_answers
+
+
+def _merge_overlapping(first: str, second: str, min_overlap: int = 10) -> str:
+    """Join two consecutive chunks of a page, leaving out the text they share because of the overlap of the splitter"""
+    for size in range(min(len(first), len(second), 2 * CHUNK_OVERLAP), min_overlap - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+
+def _position(index: ChunkIndex, row: int) -> int:
+    """Place of a chunk in the order of its document, which differs from its row in segments stored in IVF list order"""
+    return row if index.positions is None else int(index.positions[row])
+
+
+def _passages(index: ChunkIndex, selected: Sequence[int]) -> list[tuple[str, dict]]:
+    """Merge selected chunks that follow each other on the same page into passages. The passages are ordered by their
+    best ranked chunk and returned together with their metadata.
+    """
+    rank = {row: position for position, row in enumerate(selected)}
+    groups = []
+    for row in sorted(selected, key=lambda row: _position(index, row)):
+        previous = groups[-1][-1] if groups else None
+        if (
+            previous is not None
+            and _position(index, previous) == _position(index, row) - 1
+            and index.source_ids[previous] == index.source_ids[row]
+            and index.page_numbers[previous] == index.page_numbers[row]
+        ):
+            groups[-1].append(row)
+        else:
+            groups.append([row])
+    groups.sort(key=lambda group: min(rank[row] for row in group))
+    passages = []
+    for group in groups:
+        text = index.text(group[0])
+        for row in group[1:]:
+            text = _merge_overlapping(text, index.text(row))
+        passages.append((text, index.metadata(group[:1])[0]))
+    return passages
 
-    progress_message("Creating context for question")
-    question_embedded = get_embedding(client, current_question)
 
-    # Get the distances from the embeddings
-    df["distances"] = distances_from_embeddings(question_embedded, df["embeddings"].values, distance_metric="cosine")
-    df = df.sort_values("distances", ascending=True).reset_index()
+def select_chunks(index: ChunkIndex, ranked: Sequence[int], max_chunks: int, token_budget: int) -> list[int]:
+    """Select chunks in order of relevance until max_chunks is reached, skipping chunks that are near-duplicates of
+    an already selected chunk or that would not fit in the token budget. Returns the rows of the selected chunks.
+    """
+    selected = []
+    for row in ranked:
+        if len(selected) == max_chunks:
+            break
+        if selected:
+            similarity = np.max(
+                index.embeddings[selected].astype(np.float32) @ index.embeddings[row].astype(np.float32)
+            )
+            if similarity >= CONTEXT_DUPLICATE_SIMILARITY:
+                continue
+        n_tokens = sum(count_tokens(text, COMPLETIONS_MODEL) for text, _ in _passages(index, selected + [row]))
+        if n_tokens > token_budget:
+            continue
+        selected.append(row)
+    return selected
 
-    # Sort by distance and add the text to the context until the context is too long
-    context_list = []
-    metadata_list = []
-    for i, row in df.iloc[:context_number].iterrows():
-        context_list.append(row["text"])
-        metadata_list.append({"page_number": row["page_number"], "source": row["source"]})
-    context_list = [row["text"] for i, row in df.iloc[:context_number].iterrows()]
 
-    # Return the context
+def context_from_rows(index: ChunkIndex, rows: Sequence[int]) -> tuple[str, list[dict], list[str]]:
+    """Create the context from the selected chunks. Returns the context, the metadata and the text of its passages."""
+    passages = _passages(index, list(rows))
+    context_list = [text for text, _ in passages]
     context = "\n\n###\n\n".join(context_list)
-    return context, metadata_list, context_list
+    return context, [metadata for _, metadata in passages], context_list
+
+
+def create_context(
+    client: OpenAI,
+    current_question: str,
+    index: ChunkIndex,
+    context_number,
+    question_embedded: List[float] = None,
+    rows: np.ndarray = None,
+):
+    """Create a context for a question by finding the most similar chunks in the index, or only in the given rows of
+    the index. The ranking of the embeddings is fused with the ranking of the keyword index. The question is embedded,
+    unless its embedding is given or the question only asks for identifiers that the keyword index finds.
+    """
+
+    progress_message("Creating context for question")
+    n_candidates = max(context_number, N_CONTEXT_CANDIDATES)
+    lexical_candidates = []
+    if HYBRID_SEARCH and index.lexical is not None:
+        with stage("keyword search"):
+            lexical_candidates, _ = index.lexical.search(current_question, n_candidates, rows)
+    if question_embedded is None and identifier_query(current_question) and len(lexical_candidates):
+        candidates = lexical_candidates
+    else:
+        if question_embedded is None:
+            with stage("question embedding"):
+                question_embedded = get_embedding(client, current_question)
+
+        # Score all chunks (or the candidates of the approximate index) at once and only select the closest ones
+        with stage("search"):
+            candidates, _ = index.search(question_embedded, n_candidates, rows=rows)
+        if len(lexical_candidates):
+            candidates = fuse_rankings([candidates, lexical_candidates], HYBRID_RRF_K)
+    with stage("context assembly"):
+        return build_context(index, candidates, context_number)
+
+
+def build_context(
+    index: ChunkIndex, candidates: Sequence[int], context_number
+) -> tuple[str, list[dict], list[str], list[int]]:
+    """Create the context from the candidate chunks, ordered from closest to furthest, within the token budget. The
+    rows of the selected chunks are returned last.
+    """
+    token_budget = CONTEXT_TOKEN_BUDGETS.get(COMPLETIONS_MODEL, CONTEXT_TOKEN_BUDGETS["gpt-35-turbo"])
+    rows = select_chunks(index, list(map(int, candidates)), context_number, token_budget)
+    return (*context_from_rows(index, rows), rows)
@@ -0,0 +1,77 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import re
+from typing import Sequence
+
+import numpy as np
+
+_WORD = re.compile(r"\w+")
+_SHINGLE_SIZE = 3  # Words per shingle
+_SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _minhash_signature(words: list[str], multipliers: np.ndarray, increments: np.ndarray) -> np.ndarray:
+    """MinHash signature of the word shingles of a text. The fraction of equal values in the signatures of two texts
+    estimates the Jaccard similarity of their shingles.
+    """
+    # The signatures are only compared within one call of find_duplicates, so the hash of the process is good enough
+    hashes = np.array([hash(word) for word in words] or [0], dtype=np.int64).view(np.uint64)
+    shingles = hashes[: max(len(hashes) - _SHINGLE_SIZE + 1, 1)].copy()
+    for position in range(1, min(_SHINGLE_SIZE, len(hashes))):
+        shingles = shingles * _SHINGLE_MULTIPLIER + hashes[position : position + len(shingles)]
+    return (np.unique(shingles)[:, None] * multipliers + increments).min(axis=0)
+
+
+def find_duplicates(
+    texts: Sequence[str], embeddings: np.ndarray, similarity: float, n_hashes: int = 64, n_bands: int = 16
+) -> np.ndarray:
+    """Return the representative of every chunk: the first chunk with the same text, ignoring case, punctuation and
+    whitespace, or the first chunk that is nearly the same. Representatives are their own representative.
+
+    Candidates for near-duplicates are found with locality sensitive hashing of the MinHash signatures: chunks that
+    agree on all values of any band of the signature. A candidate is a duplicate when the cosine similarity of the
+    (unit) embeddings is at least the given similarity.
+    """
+    rng = np.random.default_rng(0)
+    multipliers = rng.integers(1, 2**63, n_hashes, dtype=np.uint64) | np.uint64(1)
+    increments = rng.integers(0, 2**63, n_hashes, dtype=np.uint64)
+    band_size = n_hashes // n_bands
+    representatives = np.arange(len(texts))
+    exact = {}
+    buckets = [{} for _ in range(n_bands)]
+    for row, text in enumerate(texts):
+        words = _WORD.findall(text.lower())
+        key = " ".join(words)
+        if key in exact:
+            representatives[row] = exact[key]
+            continue
+        exact[key] = row
+        signature = _minhash_signature(words, multipliers, increments)
+        band_keys = [signature[band * band_size : (band + 1) * band_size].tobytes() for band in range(n_bands)]
+        candidates = {
+            candidate for band, band_key in enumerate(band_keys) for candidate in buckets[band].get(band_key, ())
+        }
+        if candidates:
+            candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            similarities = embeddings[candidates].astype(np.float32) @ embeddings[row].astype(np.float32)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= similarity:
+                representatives[row] = candidates[best]
+                exact[key] = candidates[best]
+                continue
+        for band, band_key in enumerate(band_keys):
+            buckets[band].setdefault(band_key, []).append(row)
+    return representatives
@@ -0,0 +1,222 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import hashlib
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+from viktor.core import File
+from viktor.core import Storage
+
+from .config import EMBEDDING_CACHE_CONCURRENCY
+from .config import EMBEDDING_CACHE_MAX_ENTRIES
+from .config import EMBEDDING_CACHE_PACK_SIZE
+from .config import EMBEDDINGS_MODEL
+
+MAGIC = b"DSEC"
+FORMAT_VERSION = 1
+_PREFIX = struct.Struct("<4sHHI")  # magic, format version, reserved, header length
+_KEY_SIZE = 16
+INDEX_KEY = "embedding_cache_index"
+PACK_PREFIX = "embedding_cache_pack_"
+
+
+def cache_key(model: str, text: str) -> bytes:
+    """Content address of a chunk: a hash of the embedding model and the chunk text"""
+    return hashlib.blake2b(f"{model}\0{text}".encode("utf-8"), digest_size=_KEY_SIZE).digest()
+
+
+class EmbeddingCache:
+    """Persistent cache of chunk embeddings, shared by all PDFs and projects in the workspace.
+
+    The embeddings are stored in packs of the chunks that were added together, each a small file in the workspace
+    storage named after the hash of its keys. The index of the cache maps every key to its pack and lists the packs in
+    the order they were added. Only the packs that hold a requested chunk are downloaded, and only new packs and the
+    index are written. When the cache is full, the oldest packs are evicted, so using an embedding writes nothing.
+    Concurrent uploads that add packs at the same time may drop each other's packs from the index, which only means
+    those chunks are embedded again next time.
+    """
+
+    def __init__(
+        self,
+        model: str = EMBEDDINGS_MODEL,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        pack_size: int = EMBEDDING_CACHE_PACK_SIZE,
+    ):
+        self.model = model
+        self.max_entries = max_entries
+        self.pack_size = pack_size
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._packs = {}
+        self._pending = {}
+
+    @property
+    def index(self) -> dict:
+        """Index of the cache, loaded from storage on first use. It maps a key to its pack and position in the pack,
+        and lists the packs with their size, oldest first.
+        """
+        if self._index is None:
+            self._index = _read_index(self.model)
+        return self._index
+
+    def _pack(self, name: str) -> Optional[np.ndarray]:
+        """Embeddings of a pack, or None when the pack was evicted by a concurrent upload"""
+        try:
+            data = Storage().get(f"{PACK_PREFIX}{name}", scope="workspace").getvalue_binary()
+        except FileNotFoundError:
+            return None
+        return _deserialize_pack(data, self.model)
+
+    def lookup(self, texts: Sequence[str]) -> list[Optional[np.ndarray]]:
+        """Return the cached embedding for every text, or None when the text is not in the cache"""
+        keys = [cache_key(self.model, text) for text in texts]
+        entries = self.index["entries"]
+        missing_packs = sorted({entries[key][0] for key in keys if key in entries} - self._packs.keys())
+        if missing_packs:
+            with ThreadPoolExecutor(max_workers=min(EMBEDDING_CACHE_CONCURRENCY, len(missing_packs))) as executor:
+                self._packs.update(zip(missing_packs, executor.map(self._pack, missing_packs)))
+        embeddings = []
+        for key in keys:
+            embedding = self._pending.get(key)
+            if embedding is None and key in entries:
+                name, position = entries[key]
+                pack = self._packs[name]
+                embedding = pack[position] if pack is not None and position < len(pack) else None
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            embeddings.append(embedding)
+        return embeddings
+
+    def store(self, texts: Sequence[str], embeddings: Sequence[Sequence[float]]):
+        """Add embeddings to the cache. They are written to storage by flush."""
+        for text, embedding in zip(texts, embeddings):
+            self._pending[cache_key(self.model, text)] = np.asarray(embedding, dtype=np.float32)
+
+    def flush(self):
+        """Write the added embeddings to storage in new packs and evict the oldest packs when the cache is full"""
+        new = {key: embedding for key, embedding in self._pending.items() if key not in self.index["entries"]}
+        self._pending = {}
+        if not new:
+            return
+        storage = Storage()
+        keys = list(new)
+        packs = []
+        for start in range(0, len(keys), self.pack_size):
+            pack_keys = keys[start : start + self.pack_size]
+            name = hashlib.blake2b(b"".join(pack_keys), digest_size=_KEY_SIZE).hexdigest()
+            data = _serialize_pack(pack_keys, [new[key] for key in pack_keys], self.model)
+            storage.set(f"{PACK_PREFIX}{name}", File.from_data(data), scope="workspace")
+            packs.append((name, pack_keys))
+
+        # Start from the latest index, so the packs added by concurrent uploads since it was loaded are kept
+        index = _read_index(self.model)
+        for name, pack_keys in packs:
+            index["packs"].append([name, len(pack_keys)])
+            index["entries"].update((key, (name, position)) for position, key in enumerate(pack_keys))
+        evicted = []
+        n_entries = sum(size for _, size in index["packs"])
+        while n_entries > self.max_entries and len(index["packs"]) > 1:
+            name, size = index["packs"].pop(0)
+            evicted.append(name)
+            n_entries -= size
+        if evicted:
+            evicted_names = set(evicted)
+            index["entries"] = {key: entry for key, entry in index["entries"].items() if entry[0] not in evicted_names}
+        obsolete = [f"{PACK_PREFIX}{name}" for name in evicted] + index.pop("obsolete", [])
+        storage.set(INDEX_KEY, File.from_data(_serialize_index(index, self.model)), scope="workspace")
+        self._index = index
+        for key in obsolete:
+            try:
+                storage.delete(key, scope="workspace")
+            except FileNotFoundError:
+                pass
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = 100 * self.hits / total if total else 0
+        return f"Embedding cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate)"
+
+
+def _read_index(model: str) -> dict:
+    """Index of the cache in storage. Files that are no longer used are listed under 'obsolete', to be deleted when
+    the index is written.
+    """
+    try:
+        data = Storage().get(INDEX_KEY, scope="workspace").getvalue_binary()
+    except FileNotFoundError:
+        return {"packs": [], "entries": {}}
+    return _deserialize_index(data, model)
+
+
+def _file_prefix(header: dict) -> bytes:
+    header = json.dumps(header).encode("utf-8")
+    return _PREFIX.pack(MAGIC, FORMAT_VERSION, 0, len(header)) + header
+
+
+def _read_prefix(data: bytes) -> tuple[Optional[dict], int]:
+    """The header of a file of the cache and the offset of its data, or None when it has another format"""
+    magic, version, _, header_length = _PREFIX.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None, 0
+    return json.loads(data[_PREFIX.size : _PREFIX.size + header_length]), _PREFIX.size + header_length
+
+
+def _serialize_index(index: dict, model: str) -> bytes:
+    keys = list(index["entries"])
+    names = [name for name, _ in index["packs"]]
+    pack_ids = {name: i for i, name in enumerate(names)}
+    packs = np.array([pack_ids[index["entries"][key][0]] for key in keys], dtype=np.uint32)
+    positions = np.array([index["entries"][key][1] for key in keys], dtype=np.uint32)
+    header = {"model": model, "count": len(keys), "packs": index["packs"]}
+    return _file_prefix(header) + b"".join(keys) + packs.tobytes() + positions.tobytes()
+
+
+def _deserialize_index(data: bytes, model: str) -> dict:
+    header, offset = _read_prefix(data)
+    if header is None:
+        return {"packs": [], "entries": {}}
+    if header["model"] != model:
+        # The embeddings of another model can not be used anymore
+        return {"packs": [], "entries": {}, "obsolete": [f"{PACK_PREFIX}{name}" for name, _ in header["packs"]]}
+    count = header["count"]
+    keys = [data[offset + i * _KEY_SIZE : offset + (i + 1) * _KEY_SIZE] for i in range(count)]
+    offset += count * _KEY_SIZE
+    packs = np.frombuffer(data, dtype=np.uint32, count=count, offset=offset)
+    positions = np.frombuffer(data, dtype=np.uint32, count=count, offset=offset + packs.nbytes)
+    names = [name for name, _ in header["packs"]]
+    entries = {key: (names[pack], int(position)) for key, pack, position in zip(keys, packs, positions)}
+    return {"packs": header["packs"], "entries": entries}
+
+
+def _serialize_pack(keys: list[bytes], embeddings: list[np.ndarray], model: str) -> bytes:
+    embeddings = np.vstack(embeddings).astype(np.float32)
+    header = {"model": model, "count": len(keys), "dimension": embeddings.shape[1]}
+    return _file_prefix(header) + b"".join(keys) + embeddings.tobytes()
+
+
+def _deserialize_pack(data: bytes, model: str) -> Optional[np.ndarray]:
+    header, offset = _read_prefix(data)
+    if header is None or header["model"] != model:
+        return None
+    count, dimension = header["count"], header["dimension"]
+    offset += count * _KEY_SIZE
+    return np.frombuffer(data, dtype=np.float32, count=count * dimension, offset=offset).reshape(count, dimension)
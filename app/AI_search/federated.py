@@ -0,0 +1,122 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from viktor import UserError
+from viktor.core import progress_message
+
+from .config import FEDERATED_MAX_WORKERS
+from .config import N_CONTEXT
+from .config import N_CONTEXT_CANDIDATES
+from .context import build_context
+from .context import get_prompt
+from .helper_functions import get_chat_completion_gpt
+from .helper_functions import get_client
+from .helper_functions import get_embedding
+from .helper_functions import get_response_message
+from .index_storage import ChunkIndex
+from .language import language_instruction
+from .project_index import get_project_index
+from .tracing import in_context
+from .tracing import stage
+
+
+class FederatedAssistant:
+    """Answers a question from the indexes of several projects, for example a library of standards spread over the
+    projects of a folder.
+
+    Every project index is a shard. The shards are loaded and searched in parallel by a bounded pool of workers, so
+    the time it takes is set by the largest shard rather than by all shards together. The top k of every shard are
+    merged by their cosine distance, which is comparable between shards because they use the same embedding model.
+    """
+
+    def __init__(self, question: str, projects: list, max_workers: int = FEDERATED_MAX_WORKERS):
+        self.question = question
+        self.projects = projects
+        self.max_workers = max_workers
+        self.client = get_client()
+        self.context = ""
+        self.metadata_list = []
+        self.context_list = []
+
+    def _search_shard(self, project, question_embedding, k: int) -> tuple:
+        """Rows and distances of the k closest chunks of a project, or nothing when it has no chunks yet"""
+        try:
+            index = get_project_index(project.id, project)
+        except FileNotFoundError:
+            return None, [], []
+        if not len(index):
+            return None, [], []
+        rows, distances = index.search(question_embedding, k)
+        return index, rows, distances
+
+    def search(self):
+        """Find the closest chunks over all projects and create the context from them"""
+        progress_message(f"Searching {len(self.projects)} projects")
+        with stage("question embedding"):
+            question_embedding = get_embedding(self.client, self.question)
+        k = max(N_CONTEXT, N_CONTEXT_CANDIDATES)
+        with stage("shard search"):
+            with ThreadPoolExecutor(max_workers=max(min(self.max_workers, len(self.projects)), 1)) as executor:
+                shards = list(
+                    executor.map(
+                        in_context(lambda project: self._search_shard(project, question_embedding, k)), self.projects
+                    )
+                )
+        # Every shard is sorted from closest to furthest, so the global top k follows from a heap merge
+        merged = heapq.merge(
+            *[zip(distances, itertools.repeat(shard), rows) for shard, (_, rows, distances) in enumerate(shards)]
+        )
+        best = [(shard, int(row)) for _, shard, row in itertools.islice(merged, k)]
+        if not best:
+            raise UserError("None of the projects in this folder has submitted documents yet")
+
+        # The chunks are gathered into one small index, with the sources named after their project
+        parts = []
+        positions = {}
+        names = {}
+        for shard, (index, _, _) in enumerate(shards):
+            rows = sorted(row for best_shard, row in best if best_shard == shard)
+            if not rows:
+                continue
+            part = index.select(rows)
+            project_name = self.projects[shard].name
+            for source in part.sources:
+                names[f"{project_name}: {source}"] = (project_name, source)
+            part.sources = [f"{project_name}: {source}" for source in part.sources]
+            offset = sum(len(previous) for previous in parts)
+            positions.update({(shard, row): offset + position for position, row in enumerate(rows)})
+            parts.append(part)
+        index = ChunkIndex.concatenate(parts)
+        with stage("context assembly"):
+            self.context, self.metadata_list, self.context_list, _ = build_context(
+                index, [positions[candidate] for candidate in best], N_CONTEXT
+            )
+        for metadata in self.metadata_list:
+            for source in [metadata, *metadata["occurrences"]]:
+                source["project"], source["source"] = names[source["source"]]
+
+    def ask_assistant(self) -> str:
+        """Search all projects and ask AzureAI to answer the question from the closest chunks"""
+        self.search()
+        questions_and_answers = get_prompt(
+            {"role": "user", "content": self.question}, self.context, language_instruction(self.question)
+        )
+        progress_message("Prompt is sent to AzureAI, waiting for response...")
+        with stage("completion"):
+            return get_response_message(get_chat_completion_gpt(self.client, questions_and_answers))
@@ -12,13 +12,52 @@ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFT
 SOFTWARE.
 """
 
+import asyncio
+import hashlib
 import os
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import lru_cache
+from typing import Any
+from typing import Iterable
+from typing import Iterator
+from typing import Sequence
 
+import httpx
+import openai
+import tiktoken
 from openai import OpenAI
+from openai.lib.azure import AsyncAzureOpenAI
+from openai.lib.azure import AzureOpenAI
+from viktor import File
 
 from app.AI_search.config import COMPLETIONS_MODEL
+from app.AI_search.config import COMPLETIONS_REQUESTS_PER_MINUTE
+from app.AI_search.config import COMPLETIONS_TOKENS_PER_MINUTE
+from app.AI_search.config import EMBEDDINGS_CONCURRENCY
+from app.AI_search.config import EMBEDDINGS_MAX_BATCH_SIZE
+from app.AI_search.config import EMBEDDINGS_MAX_BATCH_TOKENS
 from app.AI_search.config import EMBEDDINGS_MODEL
+from app.AI_search.config import EMBEDDINGS_REQUESTS_PER_MINUTE
+from app.AI_search.config import EMBEDDINGS_TOKENS_PER_MINUTE
+from app.AI_search.config import HTTP_CONNECT_TIMEOUT
+from app.AI_search.config import HTTP_KEEPALIVE_EXPIRY
+from app.AI_search.config import HTTP_MAX_CONNECTIONS
+from app.AI_search.config import HTTP_MAX_KEEPALIVE_CONNECTIONS
+from app.AI_search.config import HTTP_TIMEOUT
+from app.AI_search.config import MAX_RETRIES
+from app.AI_search.config import MAX_THROTTLED_RETRIES
 from app.AI_search.config import TEMPERATURE
+from app.AI_search.embedding_cache import EmbeddingCache
+from app.AI_search.rate_limiter import RateLimiter
+from app.AI_search.rate_limiter import retry_after_seconds
+from app.AI_search.tracing import in_context
+from app.AI_search.tracing import record
 
 
 def get_API_key() -> tuple[str, str, str]:
@@ -34,10 +73,84 @@ def get_API_key() -> tuple[str, str, str]:
     return API_KEY, ENDPOINT, API_VERSION
 
 
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def _record_response(response: httpx.Response):
+    """Count the HTTP requests of the current stage, including the retries of the client"""
+    record(
+        http_requests=1, http_throttled=int(response.status_code == 429), http_errors=int(response.status_code >= 500)
+    )
+
+
+async def _record_async_response(response: httpx.Response):
+    _record_response(response)
+
+
+def _http_options() -> dict:
+    return {
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    }
+
+
+def get_client() -> AzureOpenAI:
+    """AzureAI client shared by all requests in this process. Its connection pool keeps the connections to the
+    endpoint alive, so consecutive requests do not repeat the connection setup and TLS handshake.
+    """
+    credentials = get_API_key()
+    with _clients_lock:
+        if credentials not in _clients:
+            API_KEY, ENDPOINT, API_VERSION = credentials
+            _clients[credentials] = AzureOpenAI(
+                api_key=API_KEY,
+                api_version=API_VERSION,
+                azure_endpoint=ENDPOINT,
+                max_retries=MAX_RETRIES,
+                http_client=httpx.Client(event_hooks={"response": [_record_response]}, **_http_options()),
+            )
+        return _clients[credentials]
+
+
+def get_async_client() -> AsyncAzureOpenAI:
+    """Async variant of get_client. Connections cannot be shared between event loops, so there is a client per loop."""
+    credentials = get_API_key()
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        if credentials not in clients:
+            API_KEY, ENDPOINT, API_VERSION = credentials
+            clients[credentials] = AsyncAzureOpenAI(
+                api_key=API_KEY,
+                api_version=API_VERSION,
+                azure_endpoint=ENDPOINT,
+                max_retries=MAX_RETRIES,
+                http_client=httpx.AsyncClient(event_hooks={"response": [_record_async_response]}, **_http_options()),
+            )
+        return clients[credentials]
+
+
+def file_hash(file: File) -> str:
+    """Hash of the content of a file, read in blocks so large files are not loaded in memory at once"""
+    digest = hashlib.sha256()
+    with file.open_binary() as opened:
+        for block in iter(lambda: opened.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def get_chat_completion_gpt(client: OpenAI, questions_and_answers):
     completion = client.chat.completions.create(
         model=COMPLETIONS_MODEL, messages=questions_and_answers, temperature=TEMPERATURE
     )
+    if completion.usage is not None:
+        record(prompt_tokens=completion.usage.prompt_tokens, completion_tokens=completion.usage.completion_tokens)
     return completion
 
 
@@ -47,5 +160,191 @@ def get_response_message(completion):
 
 
 def get_embedding(client: OpenAI, text_to_embed: str):
-    embedding = client.embeddings.create(input=text_to_embed, model=EMBEDDINGS_MODEL).data[0].embedding
-    return embedding
+    response = client.embeddings.create(input=text_to_embed, model=EMBEDDINGS_MODEL)
+    if response.usage is not None:
+        record(tokens=response.usage.total_tokens)
+    return response.data[0].embedding
+
+
+# The cl100k_base tokenizer ships with the app, under the name tiktoken gives it in its cache, so it is not downloaded
+_TIKTOKEN_CACHE_DIR = os.path.join(os.path.dirname(__file__), "tiktoken_cache")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Get the tokenizer of a model, falling back to the tokenizer of the ada-002 and gpt-3.5 family"""
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", _TIKTOKEN_CACHE_DIR)
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str = EMBEDDINGS_MODEL) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def batch_texts(
+    texts: Sequence[str], max_items: int = EMBEDDINGS_MAX_BATCH_SIZE, max_tokens: int = EMBEDDINGS_MAX_BATCH_TOKENS
+) -> list[tuple[list[int], int]]:
+    """Pack the texts, in order, into batches that stay within the item and token limits of a single request.
+    Each batch holds the indices of its texts and its number of tokens. A text that exceeds the token limit on its
+    own gets its own batch.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        n_tokens = count_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + n_tokens > max_tokens):
+            batches.append((batch, batch_tokens))
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += n_tokens
+    if batch:
+        batches.append((batch, batch_tokens))
+    return batches
+
+
+# Shared by all ingests running in this process, so concurrent uploads together stay within the deployment quota
+embeddings_rate_limiter = RateLimiter(EMBEDDINGS_REQUESTS_PER_MINUTE, EMBEDDINGS_TOKENS_PER_MINUTE)
+completions_rate_limiter = RateLimiter(COMPLETIONS_REQUESTS_PER_MINUTE, COMPLETIONS_TOKENS_PER_MINUTE)
+
+
+class BatchEmbedder:
+    """Embeds texts in token-aware batches, keeping several requests in flight under the shared rate limit.
+    Throttled requests are retried after the time the service asks for, instead of by the client's blind retries.
+    """
+
+    def __init__(
+        self,
+        client: OpenAI,
+        max_workers: int = EMBEDDINGS_CONCURRENCY,
+        rate_limiter: RateLimiter = None,
+        cache: EmbeddingCache = None,
+    ):
+        self.client = client.with_options(max_retries=0)
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter or embeddings_rate_limiter
+        self.cache = cache
+        self.n_texts = 0
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def embed(self, texts: Sequence[str]) -> list[list[float]]:
+        """Embed the texts. The embeddings are returned in the order of the texts. Texts that are in the cache are
+        not sent to the service.
+        """
+        [(_, embeddings)] = self.embed_stream([(None, texts)])
+        return embeddings
+
+    def embed_stream(self, items: Iterable[tuple[Any, Sequence[str]]]) -> Iterator[tuple[Any, list[list[float]]]]:
+        """Embed the texts of a stream of items, e.g. the page ranges of a PDF, with a single pool of requests. The
+        batches run across the boundaries of the items and the next items are read while requests are in flight, up to
+        twice the number of workers. Yields every item with the embeddings of its texts, in the order of the items.
+        Texts that are in the cache are not sent to the service.
+        """
+        start = time.perf_counter() - self.seconds
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        items = iter(items)
+        exhausted = False
+        groups = deque()
+        queued = []  # Group, position in the group and text of the texts that are not yet sent
+        in_flight = {}  # Group and position of the texts of every request
+
+        def submit(final: bool):
+            batches = batch_texts([text for _, _, text in queued])
+            if not final:
+                # The last batch may still be filled up with the texts of the next item
+                batches = batches[:-1]
+            for indices, n_tokens in batches:
+                slots = [queued[i] for i in indices]
+                future = executor.submit(in_context(self._embed_batch), [text for _, _, text in slots], n_tokens)
+                in_flight[future] = [(group, position) for group, position, _ in slots]
+            del queued[: sum(len(indices) for indices, _ in batches)]
+
+        try:
+            while groups or not exhausted:
+                if groups and groups[0]["remaining"] == 0:
+                    group = groups.popleft()
+                    if self.cache:
+                        missing = group["missing"]
+                        self.cache.store(
+                            [group["texts"][i] for i in missing], [group["embeddings"][i] for i in missing]
+                        )
+                        record(cache_hits=len(group["texts"]) - len(missing))
+                    self.n_texts += len(group["texts"])
+                    self.seconds = time.perf_counter() - start
+                    yield group["item"], group["embeddings"]
+                elif not exhausted and len(in_flight) < 2 * self.max_workers:
+                    try:
+                        item, texts = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        submit(final=True)
+                        continue
+                    embeddings = self.cache.lookup(texts) if self.cache else [None] * len(texts)
+                    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+                    group = {"item": item, "texts": texts, "embeddings": embeddings, "missing": missing}
+                    group["remaining"] = len(missing)
+                    groups.append(group)
+                    queued.extend((group, i, texts[i]) for i in missing)
+                    submit(final=False)
+                else:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for (group, position), embedding in zip(in_flight.pop(future), future.result()):
+                            group["embeddings"][position] = embedding
+                            group["remaining"] -= 1
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def summary(self) -> str:
+        rate = self.n_texts / self.seconds if self.seconds else 0
+        return (
+            f"Embedded {self.n_texts} chunks in {self.n_requests} requests ({rate:.1f} chunks/s), "
+            f"throttled {self.n_throttled} times"
+        )
+
+    def _embed_batch(self, texts: list[str], n_tokens: int) -> list[list[float]]:
+        """Embed a batch of texts in a single request. When the request is rejected, the batch is split in two."""
+        try:
+            return self._request(texts, n_tokens)
+        except openai.BadRequestError:
+            if len(texts) == 1:
+                raise
+            half = len(texts) // 2
+            first, second = texts[:half], texts[half:]
+            return self._embed_batch(first, sum(map(count_tokens, first))) + self._embed_batch(
+                second, sum(map(count_tokens, second))
+            )
+
+    def _request(self, texts: list[str], n_tokens: int) -> list[list[float]]:
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(n_tokens)
+            try:
+                response = self.client.embeddings.create(input=texts, model=EMBEDDINGS_MODEL)
+            except openai.RateLimitError as error:
+                with self._lock:
+                    self.n_throttled += 1
+                if attempt >= MAX_THROTTLED_RETRIES:
+                    raise
+                record(retries=1)
+                self.rate_limiter.pause(retry_after_seconds(error))
+            except (openai.APIConnectionError, openai.InternalServerError):
+                if attempt >= MAX_RETRIES:
+                    raise
+                record(retries=1)
+                time.sleep(min(2**attempt, 30))
+            else:
+                with self._lock:
+                    self.n_requests += 1
+                if response.usage is not None:
+                    record(tokens=response.usage.total_tokens)
+                # The embeddings are returned with the index of their input, which is not guaranteed to be in order
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            attempt += 1
@@ -0,0 +1,65 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import threading
+from collections import OrderedDict
+from typing import Hashable
+from typing import Optional
+
+from .config import INDEX_CACHE_MAX_BYTES
+from .index_storage import ChunkIndex
+
+
+class IndexCache:
+    """In-process LRU cache of loaded project indexes, keyed by entity id and index version.
+
+    The least recently used indexes are evicted once the cached indexes together exceed the memory budget. An index
+    that is larger than the whole budget is not cached at all.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(index.nbytes for index in self._indexes.values())
+
+    def get(self, entity_id: int, version: Hashable) -> Optional[ChunkIndex]:
+        with self._lock:
+            index = self._indexes.get((entity_id, version))
+            if index is not None:
+                self._indexes.move_to_end((entity_id, version))
+            return index
+
+    def put(self, entity_id: int, version: Hashable, index: ChunkIndex):
+        if index.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            # Older versions of the same index will never be requested again
+            for key in [key for key in self._indexes if key[0] == entity_id]:
+                del self._indexes[key]
+            self._indexes[(entity_id, version)] = index
+            while self.nbytes > self.max_bytes:
+                self._indexes.popitem(last=False)
+
+    def invalidate(self, entity_id: int):
+        with self._lock:
+            for key in [key for key in self._indexes if key[0] == entity_id]:
+                del self._indexes[key]
+
+
+index_cache = IndexCache(INDEX_CACHE_MAX_BYTES)
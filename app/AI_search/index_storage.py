@@ -0,0 +1,495 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import json
+import pickle
+import shutil
+import struct
+import tempfile
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+from viktor.core import File
+
+from .config import ANN_PROBE_FRACTION
+from .config import INDEX_RESCORE_FACTOR
+from .retrieval import QuantizedMatrix
+from .retrieval import RetrievalEngine
+from .retrieval import normalize
+from .text_store import ChunkTexts
+from .text_store import TextBlocks
+
+MAGIC = b"DSIX"
+FORMAT_VERSION = 1
+_PREFIX = struct.Struct("<4sHHI")  # magic, format version, reserved, header length
+_ALIGNMENT = 64
+_DTYPES = {"float32": np.float32, "float16": np.float16}
+_NO_SOURCE_IDS = np.empty(0, dtype=np.uint32)
+_NO_PAGE_NUMBERS = np.empty(0, dtype=np.int32)
+_MIN_RUN_LENGTH = 16  # Below this mean length of the source runs, filter_rows tests all rows at once
+
+
+class ChunkIndex:
+    """The chunks of one or more PDF documents together with their embeddings, stored column-wise.
+
+    The embeddings are stored as unit vectors plus their norms, so they can be used for scoring without any conversion.
+    The chunk texts are stored apart from the vectors, as zlib-compressed blocks of chunks with an offset table. Only
+    the blocks of the texts that are requested are read and inflated, the others stay compressed on disk.
+    Optionally, int8 codes of the embeddings are kept as well; searches scan those and rescore the best candidates with
+    the full-precision embeddings, which then mostly stay on disk when the index is memory-mapped.
+
+    Duplicate chunks are stored once. The other places where a stored chunk occurs are kept as (source, page number)
+    pairs with an offset table per chunk, in the same way as the texts.
+
+    When the rows are not in the order of their documents, positions holds the place of every row in that order.
+    """
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        norms: np.ndarray,
+        texts: ChunkTexts,
+        page_numbers: np.ndarray,
+        source_ids: np.ndarray,
+        sources: list[str],
+        model: str,
+        quantized: QuantizedMatrix = None,
+        occurrences: tuple[np.ndarray, np.ndarray, np.ndarray] = None,
+    ):
+        self.embeddings = embeddings
+        self.norms = norms
+        self.chunk_texts = texts
+        self.page_numbers = page_numbers
+        self.source_ids = source_ids
+        self.sources = sources
+        self.model = model
+        self.quantized = quantized
+        if occurrences is None:
+            occurrences = (np.zeros(len(page_numbers) + 1, dtype=np.uint64), _NO_SOURCE_IDS, _NO_PAGE_NUMBERS)
+        self.occurrence_offsets, self.occurrence_source_ids, self.occurrence_page_numbers = occurrences
+        self.ann = None
+        self.lexical = None
+        self.positions = None
+        self.version = None
+        self._engine = None
+        self._source_runs = None
+
+    @classmethod
+    def from_records(cls, records: Sequence[dict], model: str) -> "ChunkIndex":
+        """Create an index from dictionaries with the keys 'text', 'embeddings', 'page_number' and 'source'."""
+        normalized, norms = normalize([record["embeddings"] for record in records])
+        sources = list(dict.fromkeys(record["source"] for record in records))
+        source_lookup = {source: source_id for source_id, source in enumerate(sources)}
+        return cls(
+            embeddings=normalized,
+            norms=norms,
+            texts=ChunkTexts.from_texts([record["text"] for record in records]),
+            page_numbers=np.array([record["page_number"] for record in records], dtype=np.int32),
+            source_ids=np.array([source_lookup[record["source"]] for record in records], dtype=np.uint32),
+            sources=sources,
+            model=model,
+        )
+
+    @classmethod
+    def from_dataframe(cls, df, model: str) -> "ChunkIndex":
+        """Create an index from a DataFrame as it was pickled by earlier versions of the app."""
+        return cls.from_records(df[["text", "embeddings", "page_number", "source"]].to_dict("records"), model)
+
+    @classmethod
+    def concatenate(cls, indexes: Sequence["ChunkIndex"]) -> "ChunkIndex":
+        """Combine the indexes of multiple documents into a single index."""
+        if not indexes:
+            raise ValueError("At least one index is required")
+        models = {index.model for index in indexes}
+        dimensions = {index.dimension for index in indexes if len(index)}
+        if len(models) > 1 or len(dimensions) > 1:
+            raise ValueError(f"Cannot combine indexes of different embedding models: {', '.join(sorted(models))}")
+        sources = list(dict.fromkeys(source for index in indexes for source in index.sources))
+        source_lookup = {source: source_id for source_id, source in enumerate(sources)}
+        non_empty = [index.embeddings for index in indexes if len(index)]
+        quantized = [index.quantized for index in indexes if len(index)]
+        occurrence_offsets = [np.zeros(1, dtype=np.uint64)]
+        occurrence_offset = 0
+        for index in indexes:
+            occurrence_offsets.append(index.occurrence_offsets[1:] + np.uint64(occurrence_offset))
+            occurrence_offset += int(index.occurrence_offsets[-1])
+        concatenated = cls(
+            embeddings=np.concatenate(non_empty) if non_empty else indexes[0].embeddings,
+            norms=np.concatenate([index.norms for index in indexes]),
+            texts=ChunkTexts.concatenate([index.chunk_texts for index in indexes]),
+            page_numbers=np.concatenate([index.page_numbers for index in indexes]),
+            source_ids=np.concatenate(
+                [
+                    np.array([source_lookup[source] for source in index.sources], dtype=np.uint32)[index.source_ids]
+                    for index in indexes
+                ]
+            ),
+            sources=sources,
+            model=indexes[0].model,
+            quantized=QuantizedMatrix.concatenate(quantized) if quantized and None not in quantized else None,
+            occurrences=(
+                np.concatenate(occurrence_offsets),
+                np.concatenate(
+                    [
+                        np.array([source_lookup[source] for source in index.sources], dtype=np.uint32)[
+                            index.occurrence_source_ids
+                        ]
+                        for index in indexes
+                    ]
+                ),
+                np.concatenate([index.occurrence_page_numbers for index in indexes]),
+            ),
+        )
+        if all(index.positions is not None for index in indexes):
+            concatenated.positions = np.concatenate([index.positions for index in indexes])
+        return concatenated
+
+    def select(self, indices: Sequence[int]) -> "ChunkIndex":
+        """Create a new index holding only the given chunks, in the given order"""
+        indices = np.asarray(indices, dtype=np.int64)
+        occurrence_starts = self.occurrence_offsets[indices].astype(np.int64)
+        occurrence_lengths = self.occurrence_offsets[indices + 1].astype(np.int64) - occurrence_starts
+        occurrence_offsets = np.zeros(len(indices) + 1, dtype=np.uint64)
+        occurrence_offsets[1:] = np.cumsum(occurrence_lengths)
+        occurrence_rows = np.repeat(occurrence_starts - occurrence_offsets[:-1].astype(np.int64), occurrence_lengths)
+        occurrence_rows += np.arange(len(occurrence_rows))
+        occurrence_source_ids = self.occurrence_source_ids[occurrence_rows]
+        used_sources, source_ids = np.unique(
+            np.concatenate([self.source_ids[indices], occurrence_source_ids]), return_inverse=True
+        )
+        selected = ChunkIndex(
+            embeddings=self.embeddings[indices] if len(indices) else self.embeddings[:0],
+            norms=self.norms[indices],
+            texts=self.chunk_texts.select(indices),
+            page_numbers=self.page_numbers[indices],
+            source_ids=source_ids[: len(indices)].astype(np.uint32),
+            sources=[self.sources[source_id] for source_id in used_sources],
+            model=self.model,
+            quantized=None if self.quantized is None else self.quantized[indices],
+            occurrences=(
+                occurrence_offsets,
+                source_ids[len(indices) :].astype(np.uint32),
+                self.occurrence_page_numbers[occurrence_rows],
+            ),
+        )
+        if self.positions is not None:
+            selected.positions = self.positions[indices]
+        return selected
+
+    def deduplicated(self, representatives: np.ndarray) -> "ChunkIndex":
+        """Create a new index holding only the representative chunks. Every chunk is replaced by its representative,
+        the representative of a chunk being itself or an earlier chunk. The source and page number of the chunks that
+        are left out, and their own occurrences, are added to the occurrences of their representative.
+        """
+        rows = np.flatnonzero(representatives == np.arange(len(self)))
+        index = self.select(rows)
+        position = np.cumsum(representatives == np.arange(len(self))) - 1
+        occurrences = [self.occurrences(row) for row in rows]
+        for row in np.flatnonzero(representatives != np.arange(len(self))):
+            target = occurrences[position[representatives[row]]]
+            target.append((int(self.source_ids[row]), int(self.page_numbers[row])))
+            target.extend(self.occurrences(row))
+        # A chunk that is repeated on the same page, or in the same place of two documents, is cited only once
+        occurrences = [
+            [pair for pair in dict.fromkeys(pairs) if pair != (int(self.source_ids[row]), int(self.page_numbers[row]))]
+            for row, pairs in zip(rows, occurrences)
+        ]
+        source_lookup = {source: source_id for source_id, source in enumerate(index.sources)}
+        for source in self.sources:
+            if source not in source_lookup:
+                source_lookup[source] = len(index.sources)
+                index.sources.append(source)
+        index.occurrence_offsets = np.zeros(len(rows) + 1, dtype=np.uint64)
+        index.occurrence_offsets[1:] = np.cumsum([len(pairs) for pairs in occurrences])
+        pairs = [pair for pairs in occurrences for pair in pairs]
+        index.occurrence_source_ids = np.array(
+            [source_lookup[self.sources[source_id]] for source_id, _ in pairs], dtype=np.uint32
+        )
+        index.occurrence_page_numbers = np.array([page_number for _, page_number in pairs], dtype=np.int32)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.page_numbers)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the index, including the parts that are memory-mapped"""
+        arrays = (
+            self.embeddings,
+            self.norms,
+            self.page_numbers,
+            self.source_ids,
+            self.occurrence_offsets,
+            self.occurrence_source_ids,
+            self.occurrence_page_numbers,
+        )
+        return (
+            sum(array.nbytes for array in arrays)
+            + self.chunk_texts.nbytes
+            + (0 if self.quantized is None else self.quantized.nbytes)
+            + (0 if self.lexical is None else self.lexical.nbytes)
+            + (0 if self.ann is None else self.ann.nbytes)
+        )
+
+    @property
+    def dimension(self) -> int:
+        return self.embeddings.shape[1] if self.embeddings.ndim == 2 else 0
+
+    @property
+    def engine(self) -> RetrievalEngine:
+        """Retrieval engine operating directly on the stored unit vectors"""
+        if self._engine is None:
+            self._engine = RetrievalEngine(self.embeddings, self.norms, self.quantized, INDEX_RESCORE_FACTOR)
+        return self._engine
+
+    def quantize(self):
+        """Add int8 codes of the embeddings, which are then used to select the candidates of a search"""
+        self.quantized = QuantizedMatrix.from_vectors(self.embeddings) if self.dimension else None
+        self._engine = None
+
+    @property
+    def source_runs(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Offset table of the runs of consecutive rows with the same source: their start, stop, source id and whether
+        their page numbers are ascending. The rows of a document are contiguous, so there is a run per document for
+        every segment it is stored in, apart from segments that are stored in the order of their IVF lists.
+        """
+        if self._source_runs is None:
+            boundaries = np.flatnonzero(np.diff(self.source_ids.astype(np.int64))) + 1
+            starts = np.concatenate([[0], boundaries]) if len(self) else np.empty(0, dtype=np.int64)
+            stops = np.concatenate([boundaries, [len(self)]]) if len(self) else np.empty(0, dtype=np.int64)
+            descents = np.flatnonzero(np.diff(self.page_numbers) < 0) + 1
+            ascending = np.searchsorted(descents, starts, side="right") == np.searchsorted(descents, stops, side="left")
+            self._source_runs = (starts, stops, self.source_ids[starts], ascending)
+        return self._source_runs
+
+    def filter_rows(
+        self, sources: Sequence[str] = None, first_page: int = None, last_page: int = None
+    ) -> Optional[np.ndarray]:
+        """Rows of the chunks of the given sources within the page range, or None when there is no filter. The rows are
+        found through the offset table of the sources, so only the selected documents are looked at. Chunks that also
+        occur in the selected documents and pages are included.
+        """
+        if not sources and first_page is None and last_page is None:
+            return None
+        source_ids = np.array(
+            [source_id for source_id, source in enumerate(self.sources) if not sources or source in sources],
+            dtype=np.uint32,
+        )
+        first_page = np.iinfo(np.int32).min if first_page is None else first_page
+        last_page = np.iinfo(np.int32).max if last_page is None else last_page
+        parts = [np.empty(0, dtype=np.int64)]
+        if len(self.source_runs[0]) * _MIN_RUN_LENGTH > len(self):
+            # The rows of the documents are scattered over many short runs, so all rows are tested at once
+            in_range = (self.page_numbers >= first_page) & (self.page_numbers <= last_page)
+            parts.append(np.flatnonzero(np.isin(self.source_ids, source_ids) & in_range))
+        else:
+            for start, stop, source_id, ascending in zip(*self.source_runs):
+                if source_id not in source_ids:
+                    continue
+                pages = self.page_numbers[start:stop]
+                if ascending:
+                    parts.append(
+                        np.arange(
+                            start + np.searchsorted(pages, first_page, side="left"),
+                            start + np.searchsorted(pages, last_page, side="right"),
+                        )
+                    )
+                else:
+                    parts.append(start + np.flatnonzero((pages >= first_page) & (pages <= last_page)))
+        occurrences = (
+            np.isin(self.occurrence_source_ids, source_ids)
+            & (self.occurrence_page_numbers >= first_page)
+            & (self.occurrence_page_numbers <= last_page)
+        )
+        if occurrences.any():
+            parts.append(
+                np.searchsorted(self.occurrence_offsets.astype(np.int64), np.flatnonzero(occurrences), side="right") - 1
+            )
+        return np.unique(np.concatenate(parts))
+
+    def search(
+        self,
+        query_embedding: Sequence[float],
+        k: int,
+        probe_fraction: float = ANN_PROBE_FRACTION,
+        rows: np.ndarray = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return the rows and cosine distances of the k chunks closest to the query, only considering the given rows.
+        Without rows, when the index has an approximate nearest neighbour searcher, only the chunks in the closest
+        probe_fraction of the lists of each IVF index are scored.
+        """
+        if rows is not None or self.ann is None or probe_fraction is None:
+            return self.engine.search(query_embedding, k, rows=rows)
+        return self.ann.search(query_embedding, k, probe_fraction)
+
+    def search_many(
+        self, query_embeddings: Sequence[Sequence[float]], k: int, rows: np.ndarray = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return the rows and cosine distances of the k chunks closest to each query, scoring all queries at once and
+        only considering the given rows
+        """
+        return self.engine.search_many(query_embeddings, k, rows)
+
+    def text(self, i: int) -> str:
+        return self.chunk_texts.text(i)
+
+    def texts(self, indices: Sequence[int]) -> list[str]:
+        return [self.text(i) for i in indices]
+
+    def occurrences(self, i: int) -> list[tuple[int, int]]:
+        """Source id and page number of the other places where a chunk occurs"""
+        start, stop = int(self.occurrence_offsets[i]), int(self.occurrence_offsets[i + 1])
+        return list(
+            zip(self.occurrence_source_ids[start:stop].tolist(), self.occurrence_page_numbers[start:stop].tolist())
+        )
+
+    def metadata(self, indices: Sequence[int]) -> list[dict]:
+        """Page number and source document of the requested chunks, in the format used by the chat view, including the
+        other places where the chunks occur
+        """
+        return [
+            {
+                "page_number": int(self.page_numbers[i]),
+                "source": self.sources[self.source_ids[i]],
+                "occurrences": [
+                    {"page_number": page_number, "source": self.sources[source_id]}
+                    for source_id, page_number in self.occurrences(i)
+                ],
+            }
+            for i in indices
+        ]
+
+    def to_bytes(self, dtype: str = "float32") -> bytes:
+        """Serialize the index. The embeddings can be stored as float16 to halve the size of the index. The int8 codes
+        are stored as well when the index is quantized.
+        """
+        text_store = self.chunk_texts.to_store()
+        sections = {
+            "embeddings": np.ascontiguousarray(self.embeddings, dtype=_DTYPES[dtype]),
+            "norms": self.norms.astype(np.float32),
+            "page_numbers": self.page_numbers.astype(np.int32),
+            "source_ids": self.source_ids.astype(np.uint32),
+            "text_offsets": text_store.text_offsets.astype(np.uint64),
+            "text_block_offsets": text_store.block_offsets.astype(np.uint64),
+            "text_blocks": text_store.data.astype(np.uint8),
+        }
+        if self.quantized is not None:
+            sections["codes"] = np.ascontiguousarray(self.quantized.codes, dtype=np.int8)
+            sections["scale"] = self.quantized.scale
+            sections["offset"] = self.quantized.offset
+        if len(self.occurrence_source_ids):
+            sections["occurrence_offsets"] = self.occurrence_offsets.astype(np.uint64)
+            sections["occurrence_source_ids"] = self.occurrence_source_ids.astype(np.uint32)
+            sections["occurrence_page_numbers"] = self.occurrence_page_numbers.astype(np.int32)
+        layout = {}
+        offset = 0
+        for name, array in sections.items():
+            layout[name] = [offset, array.nbytes]
+            offset += _aligned(array.nbytes)
+        header = json.dumps(
+            {
+                "count": len(self),
+                "dimension": self.dimension,
+                "dtype": dtype,
+                "model": self.model,
+                "sources": self.sources,
+                "text_block_size": text_store.block_size,
+                "sections": layout,
+            }
+        ).encode("utf-8")
+        header_length = _aligned(_PREFIX.size + len(header)) - _PREFIX.size
+        parts = [_PREFIX.pack(MAGIC, FORMAT_VERSION, 0, header_length), header.ljust(header_length, b" ")]
+        for array in sections.values():
+            parts.append(array.tobytes())
+            parts.append(b"\0" * (_aligned(array.nbytes) - array.nbytes))
+        return b"".join(parts)
+
+    def to_file(self, dtype: str = "float32") -> File:
+        return File.from_data(self.to_bytes(dtype))
+
+    @classmethod
+    def from_buffer(cls, buffer: np.ndarray, model: str) -> "ChunkIndex":
+        """Load an index from a uint8 buffer without copying it. The model is used only for legacy pickled files."""
+        if buffer[:4].tobytes() != MAGIC:
+            return cls.from_dataframe(pickle.loads(buffer.tobytes()), model)
+        _, version, _, header_length = _PREFIX.unpack(buffer[: _PREFIX.size].tobytes())
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Index format version {version} is not supported, please submit the documents again")
+        header = json.loads(buffer[_PREFIX.size : _PREFIX.size + header_length].tobytes())
+        data_start = _PREFIX.size + header_length
+
+        def section(name, dtype):
+            offset, nbytes = header["sections"][name]
+            return buffer[data_start + offset : data_start + offset + nbytes].view(dtype)
+
+        quantized = None
+        if "codes" in header["sections"]:
+            quantized = QuantizedMatrix(
+                section("codes", np.int8).reshape(header["count"], header["dimension"]),
+                section("scale", np.float32),
+                section("offset", np.float32),
+            )
+        text_store = TextBlocks(
+            section("text_offsets", np.uint64),
+            section("text_blocks", np.uint8),
+            section("text_block_offsets", np.uint64),
+            header["text_block_size"],
+        )
+        occurrences = None
+        if "occurrence_offsets" in header["sections"]:
+            occurrences = (
+                section("occurrence_offsets", np.uint64),
+                section("occurrence_source_ids", np.uint32),
+                section("occurrence_page_numbers", np.int32),
+            )
+        return cls(
+            embeddings=section("embeddings", _DTYPES[header["dtype"]]).reshape(header["count"], header["dimension"]),
+            norms=section("norms", np.float32),
+            texts=ChunkTexts.from_store(text_store),
+            page_numbers=section("page_numbers", np.int32),
+            source_ids=section("source_ids", np.uint32),
+            sources=header["sources"],
+            model=header["model"],
+            quantized=quantized,
+            occurrences=occurrences,
+        )
+
+
+def _aligned(nbytes: int) -> int:
+    return -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+
+
+def map_file(file: File) -> np.ndarray:
+    """Return the content of a file as a uint8 array. Files that are not in memory yet are memory-mapped, so only the
+    parts of the file that are actually used end up in memory.
+    """
+    if file.source_type == File.SourceType.DATA:
+        return np.frombuffer(file.getvalue_binary(), dtype=np.uint8)
+    if file.source_type == File.SourceType.PATH:
+        return np.memmap(file.source, dtype=np.uint8, mode="r")
+    with tempfile.TemporaryFile() as spool:
+        with file.open_binary() as source:
+            shutil.copyfileobj(source, spool, length=1 << 20)
+        spool.flush()
+        if spool.tell() == 0:
+            return np.empty(0, dtype=np.uint8)
+        # The memory map keeps its own handle on the file, which is removed once the map is released
+        return np.memmap(spool, dtype=np.uint8, mode="r")
+
+
+def read_index(file: File, model: str) -> ChunkIndex:
+    """Load an index from storage. Files pickled by earlier versions of the app are converted on the fly."""
+    return ChunkIndex.from_buffer(map_file(file), model)
@@ -0,0 +1,94 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import re
+from typing import Optional
+
+# Frequent function words per language. Questions are short, so a handful of these is usually enough to tell the
+# languages apart without a round trip to the model.
+STOPWORDS = {
+    "English": (
+        "the a an and or of to in on at for with from by about is are was were be been has have had do does did can "
+        "could should would will what which who whom whose when where why how this that these those it its there "
+        "their they we you not no any all according"
+    ),
+    "Dutch": (
+        "de het een en of van in op aan voor met uit door over bij is zijn was waren wordt worden heeft hebben kan "
+        "kunnen moet moeten zou zal wat welke wie wanneer waar waarom hoe hoeveel dit dat deze die er hun zij wij "
+        "niet geen alle volgens ook nog"
+    ),
+    "German": (
+        "der die das ein eine einer eines und oder von zu in im auf an für mit aus bei über ist sind war waren wird "
+        "werden hat haben kann können muss müssen soll sollte was welche welcher wer wann wo warum wie wieviel dies "
+        "diese dieser es nicht kein keine alle laut auch noch dem den des"
+    ),
+    "French": (
+        "le la les un une des et ou de du au aux en dans sur pour avec par est sont était étaient être a ont peut "
+        "peuvent doit doivent quel quelle quels quelles qui quand où pourquoi comment combien ce cette ces il elle "
+        "ils elles nous vous ne pas aucun tous selon aussi"
+    ),
+    "Spanish": (
+        "el la los las un una unos unas y o de del al en sobre para con por es son era eran ser está están ha han "
+        "puede pueden debe deben cuál cuáles qué quién cuándo dónde por qué cómo cuánto este esta estos estas ello "
+        "ellos nosotros no ningún todos según también"
+    ),
+    "Italian": (
+        "il lo la i gli le un una e o di del della dei delle da in su per con è sono era erano essere ha hanno può "
+        "possono deve devono quale quali che chi quando dove perché come quanto questo questa questi quelle non "
+        "nessun tutti secondo anche"
+    ),
+    "Portuguese": (
+        "o a os as um uma e ou de do da dos das em no na nos nas para com por é são era eram ser está estão tem têm "
+        "pode podem deve devem qual quais que quem quando onde porque como quanto este esta estes estas não nenhum "
+        "todos segundo também"
+    ),
+}
+_STOPWORDS = {language: set(words.split()) for language, words in STOPWORDS.items()}
+
+# Scripts that identify a single language on their own
+_SCRIPTS = {
+    "Japanese": re.compile(r"[぀-ヿ]"),
+    "Korean": re.compile(r"[가-힯]"),
+    "Chinese": re.compile(r"[一-鿿]"),
+    "Greek": re.compile(r"[Ͱ-Ͽ]"),
+}
+
+_WORD = re.compile(r"[^\W\d_]+")
+
+
+def detect_language(text: str, min_hits: int = 2, min_ratio: float = 2.0) -> Optional[str]:
+    """Detect the language of a text offline. Returns None when unsure.
+
+    A language is only returned when at least min_hits of its function words occur in the text, and at least min_ratio
+    times as many as for the runner-up.
+    """
+    for language, pattern in _SCRIPTS.items():
+        if pattern.search(text):
+            return language
+    words = _WORD.findall(text.lower())
+    scores = sorted(
+        ((sum(word in stopwords for word in words), language) for language, stopwords in _STOPWORDS.items()),
+        reverse=True,
+    )
+    (best, language), (runner_up, _) = scores[0], scores[1]
+    if best >= min_hits and best >= min_ratio * runner_up:
+        return language
+    return None
+
+
+def language_instruction(question: str) -> str:
+    """Instruction for the language of the answer, the language of the question when it cannot be detected"""
+    language = detect_language(question)
+    return f"Answer in {language}" if language is not None else "Answer in the language of the question"
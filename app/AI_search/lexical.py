@@ -0,0 +1,221 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import io
+import re
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+
+from .retrieval import top_k
+
+# Words, and identifiers such as clause numbers (6.2.3), product codes (PX-4400) and drawing numbers (A/101), which
+# are kept as one term
+_TOKEN = re.compile(r"\w+(?:[./-]\w+)*")
+_SEPARATORS = re.compile(r"[./-]")
+
+# Words around an identifier that do not change what is asked, for example 'What does clause 6.2.3 say?'
+_FILLER_WORDS = set(
+    "a about an and any are article chapter clause code does drawing figure find for give in is item me number of on "
+    "page paragraph part product say section show table tell the to what where which".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower case terms of a text. Identifiers with separators are also indexed without them, so 'A-101' and 'A101'
+    match each other.
+    """
+    tokens = _TOKEN.findall(text.lower())
+    return tokens + [
+        _SEPARATORS.sub("", token) for token in tokens if not token.isalnum() and _SEPARATORS.search(token)
+    ]
+
+
+def is_identifier(term: str) -> bool:
+    return any(character.isdigit() for character in term) and any(character.isalnum() for character in term)
+
+
+def identifier_query(question: str) -> bool:
+    """Whether a question only asks for one or more identifiers, which the lexical index can look up by itself"""
+    terms = [term for term in _TOKEN.findall(question.lower()) if term not in _FILLER_WORDS]
+    return bool(terms) and all(is_identifier(term) for term in terms)
+
+
+class LexicalIndex:
+    """BM25 inverted index over the chunk texts.
+
+    The postings (rows and term frequencies) of all terms are stored as arrays sorted by term, with an offset table,
+    in the same way as the lists of the IVF index. The vocabulary is stored as a utf-8 blob with its own offsets.
+    """
+
+    def __init__(
+        self,
+        terms: list[str],
+        offsets: np.ndarray,
+        rows: np.ndarray,
+        frequencies: np.ndarray,
+        lengths: np.ndarray,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.k1 = k1
+        self.b = b
+        self.term_ids = {term: term_id for term_id, term in enumerate(terms)}
+
+    @classmethod
+    def from_texts(cls, texts: Sequence[str]) -> "LexicalIndex":
+        vocabulary = {}
+        term_ids = []
+        lengths = np.zeros(len(texts), dtype=np.int32)
+        for row, text in enumerate(texts):
+            ids = [vocabulary.setdefault(term, len(vocabulary)) for term in tokenize(text)]
+            term_ids.append(np.array(ids, dtype=np.int64))
+            lengths[row] = len(ids)
+        term_ids = np.concatenate(term_ids) if term_ids else np.empty(0, dtype=np.int64)
+        rows = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+        pairs, frequencies = np.unique(term_ids * max(len(texts), 1) + rows, return_counts=True)
+        return cls._from_postings(
+            list(vocabulary), pairs // max(len(texts), 1), pairs % max(len(texts), 1), frequencies, lengths
+        )
+
+    @classmethod
+    def _from_postings(
+        cls, terms: list[str], term_ids: np.ndarray, rows: np.ndarray, frequencies: np.ndarray, lengths: np.ndarray
+    ) -> "LexicalIndex":
+        """Create the index from postings in any order. The vocabulary is sorted and terms without postings dropped."""
+        used = np.unique(term_ids)
+        order = sorted(range(len(used)), key=lambda position: terms[used[position]])
+        new_ids = np.empty(len(terms), dtype=np.int64)
+        new_ids[used[order]] = np.arange(len(used))
+        term_ids = new_ids[term_ids]
+        postings = np.lexsort((rows, term_ids))
+        offsets = np.zeros(len(used) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(used)))
+        return cls(
+            [terms[used[position]] for position in order],
+            offsets,
+            rows[postings].astype(np.uint32),
+            np.minimum(frequencies[postings], np.iinfo(np.uint16).max).astype(np.uint16),
+            lengths.astype(np.int32),
+        )
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.offsets, self.rows, self.frequencies, self.lengths)
+        return sum(array.nbytes for array in arrays) + sum(len(term) for term in self.terms)
+
+    def _term_ids_of_postings(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self.terms)), np.diff(self.offsets))
+
+    def remap(self, live_rows: Optional[np.ndarray]) -> "LexicalIndex":
+        """Keep only the postings of the live rows of a segment, numbered as in the loaded project index"""
+        if live_rows is None:
+            return self
+        positions = np.minimum(np.searchsorted(live_rows, self.rows), max(len(live_rows) - 1, 0))
+        live = live_rows[positions] == self.rows if len(live_rows) else np.zeros(len(self.rows), dtype=bool)
+        return LexicalIndex._from_postings(
+            self.terms,
+            self._term_ids_of_postings()[live],
+            positions[live],
+            self.frequencies[live],
+            self.lengths[live_rows],
+        )
+
+    @classmethod
+    def concatenate(cls, indexes: Sequence["LexicalIndex"]) -> "LexicalIndex":
+        """Combine the indexes of consecutive segments into one index"""
+        terms = list(dict.fromkeys(term for index in indexes for term in index.terms))
+        lookup = {term: term_id for term_id, term in enumerate(terms)}
+        term_ids, rows, offset = [], [], 0
+        for index in indexes:
+            term_ids.append(
+                np.array([lookup[term] for term in index.terms], dtype=np.int64)[index._term_ids_of_postings()]
+            )
+            rows.append(index.rows.astype(np.int64) + offset)
+            offset += len(index)
+        return cls._from_postings(
+            terms,
+            np.concatenate(term_ids),
+            np.concatenate(rows),
+            np.concatenate([index.frequencies for index in indexes]),
+            np.concatenate([index.lengths for index in indexes]),
+        )
+
+    def search(self, query: str, k: int, rows: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """Return the rows and BM25 scores of the k best matching chunks, best first, only considering the given
+        (sorted) rows. Only chunks that contain at least one of the query terms are returned.
+        """
+        term_ids = [self.term_ids[term] for term in dict.fromkeys(tokenize(query)) if term in self.term_ids]
+        if not term_ids or not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        average_length = max(float(self.lengths.mean()), 1.0)
+        matched_rows, contributions = [], []
+        for term_id in term_ids:
+            postings = slice(self.offsets[term_id], self.offsets[term_id + 1])
+            term_rows = self.rows[postings].astype(np.int64)
+            frequencies = self.frequencies[postings].astype(np.float32)
+            idf = np.log(1 + (len(self) - len(term_rows) + 0.5) / (len(term_rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[term_rows] / average_length)
+            matched_rows.append(term_rows)
+            contributions.append(idf * frequencies * (self.k1 + 1) / (frequencies + norm))
+        matched_rows, inverse = np.unique(np.concatenate(matched_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+        if rows is not None:
+            positions = np.minimum(np.searchsorted(rows, matched_rows), max(len(rows) - 1, 0))
+            selected = rows[positions] == matched_rows if len(rows) else np.zeros(len(matched_rows), dtype=bool)
+            matched_rows, scores = matched_rows[selected], scores[selected]
+        best, _ = top_k(-scores, k)
+        return matched_rows[best], scores[best]
+
+    def to_bytes(self) -> bytes:
+        encoded_terms = [term.encode("utf-8") for term in self.terms]
+        term_offsets = np.zeros(len(encoded_terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(term) for term in encoded_terms])
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            term_data=np.frombuffer(b"".join(encoded_terms), dtype=np.uint8),
+            term_offsets=term_offsets,
+            offsets=self.offsets,
+            rows=self.rows,
+            frequencies=self.frequencies,
+            lengths=self.lengths,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LexicalIndex":
+        arrays = np.load(io.BytesIO(data), allow_pickle=False)
+        term_data, term_offsets = arrays["term_data"].tobytes(), arrays["term_offsets"]
+        terms = [term_data[start:stop].decode("utf-8") for start, stop in zip(term_offsets[:-1], term_offsets[1:])]
+        return cls(terms, arrays["offsets"], arrays["rows"], arrays["frequencies"], arrays["lengths"])
+
+
+def fuse_rankings(rankings: Sequence[Sequence[int]], k: int = 60) -> list[int]:
+    """Reciprocal rank fusion: rows are ordered by the sum of 1 / (k + rank) over the rankings they appear in"""
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            scores[int(row)] = scores.get(int(row), 0) + 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
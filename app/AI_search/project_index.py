@@ -0,0 +1,347 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import json
+from typing import Optional
+
+import numpy as np
+from viktor import UserMessage
+from viktor.core import File
+from viktor.core import Storage
+
+from .ann import ANNSearcher
+from .ann import IVFIndex
+from .config import ANN_MIN_CHUNKS
+from .config import EMBEDDINGS_MODEL
+from .config import INDEX_DEDUPLICATION
+from .config import INDEX_DTYPE
+from .config import INDEX_DUPLICATE_SIMILARITY
+from .config import INDEX_MAX_SEGMENTS
+from .config import INDEX_MAX_TOMBSTONE_FRACTION
+from .config import INDEX_QUANTIZATION
+from .deduplication import find_duplicates
+from .index_cache import index_cache
+from .index_storage import ChunkIndex
+from .index_storage import read_index
+from .lexical import LexicalIndex
+from .tracing import record
+from .tracing import stage
+
+MANIFEST_KEY = "embeddings_manifest"
+LEGACY_INDEX_KEY = "embeddings_storage"
+SEGMENT_KEY_PREFIX = "embeddings_segment_"
+
+# The project index consists of segments, each holding the chunks of one or more PDF documents, and a manifest. The
+# manifest records which version of which PDF entity lives in which rows of which segment. When a PDF is removed or
+# replaced, its rows are tombstoned rather than rewritten, and the segments are only compacted once there are too many
+# of them or too many tombstoned rows.
+#
+# Chunks that occur more than once in a segment are stored once, in the rows of the first document they occur in.
+# Documents that share chunks are linked in the manifest, so when one of them is removed or replaced, the others are
+# read again from their own index instead of losing the chunks, or keeping citations, of the removed document.
+
+
+def _storage_kwargs(entity=None) -> dict:
+    return {"scope": "entity"} if entity is None else {"scope": "entity", "entity": entity}
+
+
+def read_manifest(entity=None) -> Optional[dict]:
+    """Manifest of the project index, or None when the index was never built or built by an earlier version"""
+    try:
+        return json.loads(Storage().get(MANIFEST_KEY, **_storage_kwargs(entity)).getvalue())
+    except FileNotFoundError:
+        return None
+
+
+def document_version(pdf_entity) -> str:
+    """Version of the processed PDF, PDFs processed by earlier versions of the app all share the same version"""
+    try:
+        return json.loads(Storage().get("pdf_version", scope="entity", entity=pdf_entity).getvalue())["document_hash"]
+    except FileNotFoundError:
+        return "unversioned"
+
+
+def _live_rows(segment: dict) -> Optional[np.ndarray]:
+    """Rows of a segment that are not tombstoned, or None when all rows are live"""
+    if not segment["tombstones"]:
+        return None
+    mask = np.ones(segment["count"], dtype=bool)
+    for start, stop in segment["tombstones"]:
+        mask[start:stop] = False
+    return np.flatnonzero(mask)
+
+
+def _n_tombstoned(segment: dict) -> int:
+    return sum(stop - start for start, stop in segment["tombstones"])
+
+
+def count_chunks(manifest: dict) -> int:
+    """Number of live chunks in the project index"""
+    return sum(segment["count"] - _n_tombstoned(segment) for segment in manifest["segments"].values())
+
+
+def load_project_index(entity=None) -> tuple[ChunkIndex, Optional[dict]]:
+    """Load the live chunks of all segments of a project index, together with its manifest"""
+    manifest = read_manifest(entity)
+    if manifest is None:
+        return read_index(Storage().get(LEGACY_INDEX_KEY, **_storage_kwargs(entity)), EMBEDDINGS_MODEL), None
+    indexes = []
+    lexical_indexes = []
+    ivf_indexes = []
+    exact_rows = []
+    positions = []
+    offset = 0
+    position = 0
+    for segment_key, segment in manifest["segments"].items():
+        index = read_index(Storage().get(segment_key, **_storage_kwargs(entity)), EMBEDDINGS_MODEL)
+        if segment.get("ann"):
+            ivf_index = IVFIndex.from_bytes(
+                Storage().get(f"{segment_key}_ivf", **_storage_kwargs(entity)).getvalue_binary()
+            )
+            stored_rows = ivf_index.list_rows
+        else:
+            stored_rows = np.arange(segment["count"])
+        live_rows = _live_rows(segment)
+        if live_rows is not None:
+            # The tombstones refer to the rows of the documents, the rows of a segment with an IVF index are stored in
+            # the order of its lists
+            live_rows = np.flatnonzero(np.isin(stored_rows, live_rows))
+            stored_rows = stored_rows[live_rows]
+        lexical_index = LexicalIndex.from_bytes(
+            Storage().get(f"{segment_key}_bm25", **_storage_kwargs(entity)).getvalue_binary()
+        )
+        lexical_indexes.append(lexical_index.remap(live_rows))
+        if live_rows is not None:
+            index = index.select(live_rows)
+        if segment.get("ann"):
+            ivf_indexes.append(ivf_index.remap(live_rows, offset))
+        else:
+            exact_rows.append(np.arange(offset, offset + len(index)))
+        indexes.append(index)
+        positions.append(position + stored_rows)
+        offset += len(index)
+        position += segment["count"]
+    if not indexes:
+        index = ChunkIndex.from_records([], EMBEDDINGS_MODEL)
+        index.version = manifest["version"]
+        return index, manifest
+    index = indexes[0] if len(indexes) == 1 else ChunkIndex.concatenate(indexes)
+    index.version = manifest["version"]
+    index.positions = np.concatenate(positions)
+    index.lexical = lexical_indexes[0] if len(lexical_indexes) == 1 else LexicalIndex.concatenate(lexical_indexes)
+    if ivf_indexes:
+        index.ann = ANNSearcher(
+            ivf_indexes, np.concatenate(exact_rows or [np.empty(0, dtype=np.int64)]), index.embeddings
+        )
+    return index, manifest
+
+
+def get_project_index(entity_id: int, entity=None) -> ChunkIndex:
+    """Project index of the current entity, or of the given entity, served from the in-process cache when its version
+    is already loaded
+    """
+    manifest = read_manifest(entity)
+    if manifest is not None:
+        index = index_cache.get(entity_id, manifest["version"])
+        if index is not None:
+            record(index_cache_hits=1)
+            return index
+    with stage("index download"):
+        index, manifest = load_project_index(entity)
+    if manifest is not None:
+        index_cache.put(entity_id, manifest["version"], index)
+    return index
+
+
+def _write_segment(manifest: dict, segment_key: str, index: ChunkIndex):
+    """Store a new segment, with the BM25 keyword index of its texts, and add it to the manifest. Large segments get an
+    IVF index for approximate search, and are stored in the order of its lists. Segments are stored with int8 codes
+    when quantization is enabled.
+    """
+    ivf_index = None
+    if ANN_MIN_CHUNKS is not None and len(index) >= ANN_MIN_CHUNKS:
+        UserMessage.info("Building the approximate nearest neighbour index")
+        with stage("ann training"):
+            ivf_index = IVFIndex.train(index.embeddings)
+            index = index.select(ivf_index.list_rows)
+    with stage("keyword index"):
+        lexical_index = LexicalIndex.from_texts(index.texts(range(len(index))))
+    with stage("segment upload"):
+        if INDEX_QUANTIZATION == "int8":
+            index.quantize()
+        Storage().set(segment_key, index.to_file(INDEX_DTYPE), scope="entity")
+        Storage().set(f"{segment_key}_bm25", File.from_data(lexical_index.to_bytes()), scope="entity")
+        if ivf_index is not None:
+            Storage().set(f"{segment_key}_ivf", File.from_data(ivf_index.to_bytes()), scope="entity")
+    manifest["segments"][segment_key] = {"count": len(index), "tombstones": [], "ann": ivf_index is not None}
+    manifest["next_segment"] += 1
+
+
+def _deduplicate(index: ChunkIndex, documents: list[dict]) -> ChunkIndex:
+    """Store the duplicate chunks of a new segment once. The row ranges of the documents of the segment are updated to
+    the remaining rows, and documents whose chunks are stored in the rows of another document are linked to it.
+    """
+    if not INDEX_DEDUPLICATION or not len(index):
+        return index
+    with stage("deduplication"):
+        representatives = find_duplicates(index.texts(range(len(index))), index.embeddings, INDEX_DUPLICATE_SIMILARITY)
+        owners = np.zeros(len(index), dtype=np.int64)
+        for position, document in enumerate(documents):
+            owners[document["start"] : document["stop"]] = position
+        for row in np.flatnonzero(representatives != np.arange(len(index))):
+            first, second = documents[owners[representatives[row]]], documents[owners[row]]
+            if first is not second:
+                first["duplicates_with"] = sorted(set(first.get("duplicates_with", [])) | {second["entity_id"]})
+                second["duplicates_with"] = sorted(set(second.get("duplicates_with", [])) | {first["entity_id"]})
+        n_kept = np.zeros(len(index) + 1, dtype=np.int64)
+        n_kept[1:] = np.cumsum(representatives == np.arange(len(index)))
+        for document in documents:
+            document["start"], document["stop"] = int(n_kept[document["start"]]), int(n_kept[document["stop"]])
+        deduplicated = index.deduplicated(representatives)
+    UserMessage.info(f"{len(index) - len(deduplicated)} duplicate chunk(s) stored once")
+    return deduplicated
+
+
+def _segment_keys(manifest: dict, segment_key: str) -> list[str]:
+    """Storage keys of a segment, its keyword index and its IVF index, if it has one"""
+    segment = manifest["segments"][segment_key]
+    keys = [segment_key, f"{segment_key}_bm25"]
+    if segment.get("ann"):
+        keys.append(f"{segment_key}_ivf")
+    return keys
+
+
+def _compact(manifest: dict) -> list[str]:
+    """Rewrite all live rows into a single segment. Returns the keys of the segments that became obsolete."""
+    UserMessage.info("Compacting the document index")
+    segment_key = f"{SEGMENT_KEY_PREFIX}{manifest['next_segment']}"
+    indexes = []
+    documents = []
+    offset = 0
+    for key, segment in manifest["segments"].items():
+        index = read_index(Storage().get(key, scope="entity"), EMBEDDINGS_MODEL)
+        if segment.get("ann"):
+            # The segment is rewritten in the order of its documents rather than of its IVF lists
+            ivf_index = IVFIndex.from_bytes(Storage().get(f"{key}_ivf", scope="entity").getvalue_binary())
+            index = index.select(np.argsort(ivf_index.list_rows))
+        live_rows = _live_rows(segment)
+        if live_rows is None:
+            live_rows = np.arange(segment["count"])
+        else:
+            index = index.select(live_rows)
+        for document in manifest["documents"]:
+            if document["segment"] == key:
+                n_rows = document["stop"] - document["start"]
+                document["start"] = offset + int(np.searchsorted(live_rows, document["start"]))
+                document["stop"] = document["start"] + n_rows
+                document["segment"] = segment_key
+                documents.append(document)
+        indexes.append(index)
+        offset += len(index)
+    obsolete = [key for old_key in manifest["segments"] for key in _segment_keys(manifest, old_key)]
+    manifest["segments"] = {}
+    _write_segment(manifest, segment_key, _deduplicate(ChunkIndex.concatenate(indexes), documents))
+    return obsolete
+
+
+def _needs_compaction(manifest: dict) -> bool:
+    n_rows = sum(segment["count"] for segment in manifest["segments"].values())
+    n_tombstoned = sum(_n_tombstoned(segment) for segment in manifest["segments"].values())
+    return len(manifest["segments"]) > INDEX_MAX_SEGMENTS or n_tombstoned > INDEX_MAX_TOMBSTONE_FRACTION * n_rows
+
+
+def update_project_index(pdf_entities) -> dict:
+    """Bring the project index in line with the given PDF entities. Only PDFs that were added or replaced since the
+    previous update are downloaded, removed PDFs are tombstoned. Returns the new manifest.
+    """
+    with stage("document versions"):
+        manifest = read_manifest() or {"version": 0, "next_segment": 0, "segments": {}, "documents": []}
+        current = {pdf_entity.id: (pdf_entity, document_version(pdf_entity)) for pdf_entity in pdf_entities}
+
+    documents = []
+    removed = []
+    for document in manifest["documents"]:
+        pdf_entity, version = current.get(document["entity_id"], (None, None))
+        if version == document["version"]:
+            document["name"] = pdf_entity.name
+            documents.append(document)
+        else:
+            removed.append(document)
+
+    # Documents sharing chunks with a removed document are read again, as are the documents they share chunks with
+    unchanged = {document["entity_id"]: document for document in documents}
+    linked = list(removed)
+    while linked:
+        for entity_id in linked.pop().get("duplicates_with", []):
+            if entity_id in unchanged:
+                document = unchanged.pop(entity_id)
+                documents.remove(document)
+                removed.append(document)
+                linked.append(document)
+    known = {document["entity_id"] for document in documents}
+    added = [(pdf_entity, version) for entity_id, (pdf_entity, version) in current.items() if entity_id not in known]
+    UserMessage.info(f"{len(added)} document(s) added, {len(removed)} removed, {len(documents)} unchanged")
+    if not added and not removed:
+        return manifest
+
+    for document in removed:
+        if document["segment"] is not None:
+            manifest["segments"][document["segment"]]["tombstones"].append([document["start"], document["stop"]])
+
+    if added:
+        segment_key = f"{SEGMENT_KEY_PREFIX}{manifest['next_segment']}"
+        indexes = []
+        new_documents = []
+        offset = 0
+        for pdf_entity, version in added:
+            UserMessage.info(f"Receiving data for {pdf_entity.name}")
+            with stage("document download"):
+                pdf_file = Storage().get("pdf_storage", scope="entity", entity=pdf_entity)
+                index = read_index(pdf_file, EMBEDDINGS_MODEL)
+            new_documents.append(
+                {
+                    "entity_id": pdf_entity.id,
+                    "name": pdf_entity.name,
+                    "version": version,
+                    "segment": segment_key if len(index) else None,
+                    "start": offset,
+                    "stop": offset + len(index),
+                }
+            )
+            indexes.append(index)
+            offset += len(index)
+        if offset:
+            _write_segment(manifest, segment_key, _deduplicate(ChunkIndex.concatenate(indexes), new_documents))
+        documents += new_documents
+    manifest["documents"] = documents
+
+    # Segments without any live rows are dropped right away, the others only when compaction is due
+    obsolete = []
+    for segment_key, segment in list(manifest["segments"].items()):
+        if _n_tombstoned(segment) >= segment["count"]:
+            obsolete += _segment_keys(manifest, segment_key)
+            del manifest["segments"][segment_key]
+    if manifest["segments"] and _needs_compaction(manifest):
+        with stage("compaction"):
+            obsolete += _compact(manifest)
+
+    manifest["version"] += 1
+    Storage().set(MANIFEST_KEY, File.from_data(json.dumps(manifest)), scope="entity")
+    for key in obsolete + [LEGACY_INDEX_KEY]:
+        try:
+            Storage().delete(key, scope="entity")
+        except FileNotFoundError:
+            pass
+    return manifest
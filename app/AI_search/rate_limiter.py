@@ -0,0 +1,98 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import openai
+
+
+class RateLimiter:
+    """Token bucket limiter on both the requests and the tokens per minute, shared by all threads of the process.
+
+    When the service throttles a request anyway, all threads are paused for the time the service asks for.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._available_requests = min(
+            self.requests_per_minute, self._available_requests + elapsed * self.requests_per_minute / 60
+        )
+        self._available_tokens = min(
+            self.tokens_per_minute, self._available_tokens + elapsed * self.tokens_per_minute / 60
+        )
+
+    def acquire(self, n_tokens: int) -> float:
+        """Block until a request of n_tokens tokens may be sent. Returns the time that was waited, in seconds."""
+        # A single request larger than the bucket would never fit, it is let through once the bucket is full
+        n_tokens = min(n_tokens, self.tokens_per_minute)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._available_requests >= 1 and self._available_tokens >= n_tokens:
+                    self._available_requests -= 1
+                    self._available_tokens -= n_tokens
+                    return waited
+                wait = max(
+                    self._paused_until - now,
+                    (1 - self._available_requests) * 60 / self.requests_per_minute,
+                    (n_tokens - self._available_tokens) * 60 / self.tokens_per_minute,
+                )
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float):
+        """Hold back all requests for the given time, e.g. after the service responded with 429"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def retry_after_seconds(error: openai.APIStatusError, default: float = 1.0) -> float:
+    """Read the time to wait from the retry-after headers of a throttled response"""
+    headers = error.response.headers
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            retry_at = _parse_http_date(headers["retry-after"])
+            if retry_at is not None:
+                return max(retry_at - time.time(), 0.0)
+    return default
+
+
+def _parse_http_date(value: str) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,250 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from typing import Sequence
+
+import numpy as np
+
+# Number of rows that are reconstructed at once for the L1 and Linf kernels, to bound the memory of the temporaries
+_BLOCK_SIZE = 8192
+_SCAN_BLOCK_SIZE = 1024  # Rows of int8 codes that are converted at once when scanning a quantized matrix
+
+
+class QuantizedMatrix:
+    """Unit vectors scalar-quantized to int8, with a scale and offset per dimension.
+
+    The codes take a quarter of the memory of a float32 matrix. Their dot products with a query only serve to select
+    candidates, which are rescored with the full-precision vectors.
+    """
+
+    def __init__(self, codes: np.ndarray, scale: np.ndarray, offset: np.ndarray):
+        self.codes = codes
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+
+    @classmethod
+    def from_vectors(cls, vectors: np.ndarray) -> "QuantizedMatrix":
+        """Quantize the vectors, mapping the range of each dimension onto the 256 int8 levels"""
+        low = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        high = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(vectors), _BLOCK_SIZE):
+            block = vectors[start : start + _BLOCK_SIZE]
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        if not len(vectors):
+            low = high = np.zeros(vectors.shape[1], dtype=np.float32)
+        scale = np.maximum((high - low) / 255, np.finfo(np.float32).tiny)
+        return cls(_encode(vectors, scale, low), scale, low)
+
+    @classmethod
+    def concatenate(cls, matrices: Sequence["QuantizedMatrix"]) -> "QuantizedMatrix":
+        """Combine quantized matrices under a common scale and offset. Only the codes are read, so the full-precision
+        vectors of memory-mapped indexes stay on disk.
+        """
+        low = np.min([matrix.offset for matrix in matrices], axis=0)
+        high = np.max([matrix.offset + 255 * matrix.scale for matrix in matrices], axis=0)
+        scale = np.maximum((high - low) / 255, np.finfo(np.float32).tiny)
+        codes = [_encode(matrix.dequantize(), scale, low) for matrix in matrices]
+        return cls(np.concatenate(codes), scale, low)
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    def __getitem__(self, rows) -> "QuantizedMatrix":
+        return QuantizedMatrix(self.codes[rows], self.scale, self.offset)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scale.nbytes + self.offset.nbytes
+
+    def dequantize(self, rows: np.ndarray = None) -> np.ndarray:
+        codes = self.codes if rows is None else self.codes[rows]
+        return (codes.astype(np.float32) + 128) * self.scale + self.offset
+
+    def scores(self, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """Dot products of the query with the quantized vectors, up to a constant that is the same for all rows"""
+        weights = query * self.scale
+        if rows is not None:
+            return self.codes[rows].astype(np.float32) @ weights
+        # The codes are converted in small blocks into one buffer, which stays in the CPU cache
+        scores = np.empty(len(self), dtype=np.float32)
+        buffer = np.empty((min(_SCAN_BLOCK_SIZE, len(self)), self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(self), _SCAN_BLOCK_SIZE):
+            block = buffer[: len(self.codes[start : start + _SCAN_BLOCK_SIZE])]
+            block[...] = self.codes[start : start + _SCAN_BLOCK_SIZE]
+            scores[start : start + _SCAN_BLOCK_SIZE] = block @ weights
+        return scores
+
+
+def _encode(vectors: np.ndarray, scale: np.ndarray, offset: np.ndarray) -> np.ndarray:
+    codes = np.empty(vectors.shape, dtype=np.int8)
+    for start in range(0, len(vectors), _BLOCK_SIZE):
+        block = (vectors[start : start + _BLOCK_SIZE].astype(np.float32) - offset) / scale
+        codes[start : start + _BLOCK_SIZE] = np.clip(np.rint(block) - 128, -128, 127)
+    return codes
+
+
+class RetrievalEngine:
+    """Scores a query embedding against all chunk embeddings at once and selects the closest chunks.
+
+    The embeddings are kept as a contiguous matrix of unit vectors, together with their original norms. Cosine and L2
+    distances then follow from a single matrix-vector product, the L1 and Linf distances are computed in blocks.
+    When int8 codes of the unit vectors are available, a cosine search scans the codes and only rescores the best
+    rescore_factor * k candidates with the full-precision vectors.
+    """
+
+    metrics = ("cosine", "L1", "L2", "Linf")
+
+    def __init__(
+        self,
+        normalized: np.ndarray,
+        norms: np.ndarray,
+        quantized: QuantizedMatrix = None,
+        rescore_factor: int = 4,
+    ):
+        if normalized.ndim != 2:
+            raise ValueError(f"Expected a 2D embedding matrix, got an array with shape {normalized.shape}")
+        self.normalized = normalized
+        self.norms = np.asarray(norms, dtype=np.float32)
+        self.quantized = quantized
+        self.rescore_factor = rescore_factor
+
+    @classmethod
+    def from_embeddings(cls, embeddings: Sequence[Sequence[float]]) -> "RetrievalEngine":
+        """Create the engine from raw embeddings, e.g. the 'embeddings' column of a DataFrame."""
+        normalized, norms = normalize(embeddings)
+        return cls(normalized, norms)
+
+    def __len__(self) -> int:
+        return self.normalized.shape[0]
+
+    def _similarities(self, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """Dot products of the query with the unit vectors. Compact (e.g. float16) matrices are upcast in blocks."""
+        if rows is not None:
+            return self.normalized[rows].astype(np.float32) @ query
+        if self.normalized.dtype == np.float32:
+            return self.normalized @ query
+        similarities = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), _BLOCK_SIZE):
+            similarities[start : start + _BLOCK_SIZE] = (
+                self.normalized[start : start + _BLOCK_SIZE].astype(np.float32) @ query
+            )
+        return similarities
+
+    def distances(
+        self, query_embedding: Sequence[float], distance_metric: str = "cosine", rows: np.ndarray = None
+    ) -> np.ndarray:
+        """Return the distances between the query embedding and every embedding in the engine, or only the embeddings
+        in the given rows.
+        """
+        if (len(self) if rows is None else len(rows)) == 0:
+            return np.empty(0, dtype=np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norms = self.norms if rows is None else self.norms[rows]
+        if distance_metric == "cosine":
+            query_norm = np.linalg.norm(query)
+            return 1 - self._similarities(query / query_norm if query_norm > 0 else query, rows)
+        if distance_metric == "L2":
+            # |q - x|^2 = |q|^2 + |x|^2 - 2 |x| (q . x_hat)
+            squared = query @ query + norms**2 - 2 * norms * self._similarities(query, rows)
+            return np.sqrt(np.maximum(squared, 0))
+        if distance_metric in ("L1", "Linf"):
+            rows = np.arange(len(self)) if rows is None else rows
+            distances = np.empty(len(rows), dtype=np.float32)
+            for start in range(0, len(rows), _BLOCK_SIZE):
+                block = rows[start : start + _BLOCK_SIZE]
+                embeddings = self.normalized[block].astype(np.float32) * self.norms[block, None]
+                differences = np.abs(embeddings - query)
+                distances[start : start + _BLOCK_SIZE] = (
+                    differences.sum(axis=1) if distance_metric == "L1" else differences.max(axis=1)
+                )
+            return distances
+        raise ValueError(f"Unknown distance metric '{distance_metric}', choose from {', '.join(self.metrics)}")
+
+    def search(
+        self, query_embedding: Sequence[float], k: int, distance_metric: str = "cosine", rows: np.ndarray = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return the indices and distances of the k closest embeddings, sorted from closest to furthest. When rows
+        are given, only those embeddings are considered.
+        """
+        n_candidates = len(self) if rows is None else len(rows)
+        if k <= 0 or n_candidates == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self.quantized is not None and distance_metric == "cosine" and k * self.rescore_factor < n_candidates:
+            query = np.asarray(query_embedding, dtype=np.float32)
+            candidates, _ = top_k(-self.quantized.scores(query, rows), k * self.rescore_factor)
+            rows = candidates if rows is None else rows[candidates]
+        distances = self.distances(query_embedding, distance_metric, rows)
+        indices, distances = top_k(distances, k)
+        return (indices if rows is None else rows[indices]), distances
+
+    def search_many(
+        self, query_embeddings: Sequence[Sequence[float]], k: int, rows: np.ndarray = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Cosine search for several queries at once. The similarities of a block of embeddings with all queries
+        follow from a single matrix-matrix product, and only the k best rows per query are kept of every block.
+        Returns the indices and distances as arrays of shape (number of queries, k). When rows are given, only those
+        embeddings are considered.
+        """
+        queries, _ = normalize(query_embeddings)
+        n_candidates = len(self) if rows is None else len(rows)
+        k = min(k, n_candidates)
+        if k <= 0 or not len(queries):
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = []
+        best_similarities = []
+        for start in range(0, n_candidates, _BLOCK_SIZE):
+            block = (
+                self.normalized[start : start + _BLOCK_SIZE]
+                if rows is None
+                else self.normalized[rows[start : start + _BLOCK_SIZE]]
+            )
+            similarities = block.astype(np.float32, copy=False) @ queries.T
+            n_best = min(k, len(similarities))
+            best = np.argpartition(-similarities, n_best - 1, axis=0)[:n_best]
+            best_rows.append(best + start)
+            best_similarities.append(np.take_along_axis(similarities, best, axis=0))
+        candidates = np.concatenate(best_rows)
+        similarities = np.concatenate(best_similarities)
+        order = np.argsort(-similarities, axis=0, kind="stable")[:k]
+        indices = np.take_along_axis(candidates, order, axis=0).T
+        return (indices if rows is None else rows[indices]), 1 - np.take_along_axis(similarities, order, axis=0).T
+
+
+def normalize(embeddings: Sequence[Sequence[float]]) -> tuple[np.ndarray, np.ndarray]:
+    """Return the embeddings as a contiguous float32 matrix of unit vectors, together with their original norms."""
+    if len(embeddings) == 0:
+        return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.float32)
+    if isinstance(embeddings, np.ndarray) and embeddings.ndim == 2:
+        matrix = embeddings.astype(np.float32)
+    else:
+        matrix = np.vstack([np.asarray(embedding, dtype=np.float32) for embedding in embeddings])
+    norms = np.linalg.norm(matrix, axis=1)
+    matrix /= np.where(norms > 0, norms, 1)[:, None]
+    return np.ascontiguousarray(matrix), norms.astype(np.float32)
+
+
+def top_k(distances: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Select the k smallest distances with a partial selection, and only sort those."""
+    k = min(k, len(distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=distances.dtype)
+    if k < len(distances):
+        candidates = np.argpartition(distances, k - 1)[:k]
+    else:
+        candidates = np.arange(len(distances))
+    order = np.argsort(distances[candidates], kind="stable")
+    indices = candidates[order]
+    return indices, distances[indices]
@@ -12,43 +12,77 @@ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFT
 SOFTWARE.
 """
 
+import logging
+
+import numpy as np
 import openai
-from openai.lib.azure import AzureOpenAI
 from viktor.core import progress_message
 
-from .config import MAX_RETRIES
+from .answer_cache import AnswerCache
 from .config import N_CONTEXT
-from .config import SYSTEM_MESSAGE
+from .context import context_from_rows
 from .context import create_context
-from .context import get_question_for_language
-from .context import get_question_with_context
-from .helper_functions import get_API_key
+from .context import get_prompt
 from .helper_functions import get_chat_completion_gpt
+from .helper_functions import get_client
+from .helper_functions import get_embedding
 from .helper_functions import get_response_message
+from .index_storage import ChunkIndex
+from .language import language_instruction
+from .lexical import identifier_query
+from .tracing import record
+from .tracing import stage
+
+logger = logging.getLogger(__name__)
 
 
 class RetrievalAssistant:
     """Class for constructing the conversation and making the API calls to AzureAI"""
 
-    def __init__(self, question, df):
+    def __init__(self, question, index: ChunkIndex, answer_cache: AnswerCache = None, rows: np.ndarray = None):
         self.question = question
         self.context = ""
         self.metadata_list = []
         self.context_list = []
+        self.context_rows = []
         self.current_question = {}
-        self.df = df
-        API_KEY, ENDPOINT, API_VERSION = get_API_key()
-        self.client = AzureOpenAI(
-            api_key=API_KEY, api_version=API_VERSION, azure_endpoint=ENDPOINT, max_retries=MAX_RETRIES
-        )
+        self.index = index
+        self.rows = rows
+        self.language_instruction = ""
+        self.question_embedding = None
+        self.answer_cache = answer_cache
+        self.cached_answer = None
+        self.client = get_client()
 
         self._set_current_question(self.question)
+        if self.answer_cache is not None:
+            with stage("answer cache"):
+                self.cached_answer = self.answer_cache.lookup(self.question)
+        if self.cached_answer is None:
+            self._prepare_question()
+            if self.answer_cache is not None:
+                with stage("answer cache"):
+                    self.cached_answer = self.answer_cache.lookup_similar(
+                        self.question_embedding, self.context_rows, self.language_instruction
+                    )
+        if self.cached_answer is not None:
+            self.context_rows = self.cached_answer["rows"]
+            self.context, self.metadata_list, self.context_list = context_from_rows(self.index, self.context_rows)
+
+    def _prepare_question(self):
+        """Create the context and determine the language of the answer, which is detected locally"""
+        self.language_instruction = language_instruction(self.question)
         self._create_context()
 
     def _create_context(self):
-        """Set the context for the question"""
-        self.context, self.metadata_list, self.context_list = create_context(
-            self.client, self.question, self.df, N_CONTEXT
+        """Set the context for the question. Questions that only ask for identifiers are left to the keyword index,
+        without embedding them.
+        """
+        if self.index.lexical is None or not identifier_query(self.question):
+            with stage("question embedding"):
+                self.question_embedding = get_embedding(self.client, self.question)
+        self.context, self.metadata_list, self.context_list, self.context_rows = create_context(
+            self.client, self.question, self.index, N_CONTEXT, self.question_embedding, self.rows
         )
 
     def _set_current_question(self, question: str):
@@ -56,18 +90,25 @@ class RetrievalAssistant:
         self.current_question = {"role": "user", "content": question}
 
     def ask_assistant(self):
-        """Method for preparing the question and then asking it to AzureAI"""
+        """Method for preparing the question and then asking it to AzureAI. Cached answers are returned as is."""
+        if self.cached_answer is not None:
+            logger.info("Question answered from the cache")
+            record(answer_cache_hits=1)
+            return self.cached_answer["answer"]
         progress_message("Setting up question...")
-        completion_question = get_chat_completion_gpt(self.client, get_question_for_language(self.current_question))
-        language_question = get_response_message(completion_question)
-
-        questions_and_answers = []
-        questions_and_answers.append(get_question_with_context(self.current_question, self.context))
-
-        # Insert at the end to make it more accurate
-        questions_and_answers.append({"role": "system", "content": SYSTEM_MESSAGE + language_question})
+        questions_and_answers = get_prompt(self.current_question, self.context, self.language_instruction)
         progress_message("Prompt is sent to AzureAI, waiting for response...")
-        completion = get_chat_completion_gpt(self.client, questions_and_answers)
+        with stage("completion"):
+            completion = get_chat_completion_gpt(self.client, questions_and_answers)
         progress_message("Answer received from AzureAI, saving results...")
         response_message = get_response_message(completion)
+        if self.answer_cache is not None:
+            self.answer_cache.store(
+                self.question,
+                self.question_embedding,
+                self.language_instruction,
+                response_message,
+                self.context_rows,
+            )
+            self.answer_cache.save()
         return response_message
@@ -0,0 +1,150 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Sequence
+
+import numpy as np
+
+from .config import TEXT_BLOCK_CHUNKS
+
+_CACHED_BLOCKS = 4  # Inflated blocks kept per store, enough for reading all texts in order
+_CACHED_TEXTS = 256  # Decoded texts kept per index, enough for the candidates of a context
+
+
+class TextBlocks:
+    """The chunk texts of one stored index, as zlib-compressed blocks of consecutive chunks with an offset table.
+
+    The offsets of the texts refer to the inflated texts, the offsets of the blocks to the compressed data. A block is
+    only inflated when one of its texts is requested.
+    """
+
+    def __init__(
+        self,
+        text_offsets: np.ndarray,
+        data: np.ndarray,
+        block_offsets: np.ndarray,
+        block_size: int = TEXT_BLOCK_CHUNKS,
+    ):
+        self.text_offsets = text_offsets
+        self.data = data
+        self.block_offsets = block_offsets
+        self.block_size = block_size
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_texts(cls, texts: Sequence[str], block_size: int = TEXT_BLOCK_CHUNKS) -> "TextBlocks":
+        encoded_texts = [text.encode("utf-8") for text in texts]
+        text_offsets = np.zeros(len(encoded_texts) + 1, dtype=np.uint64)
+        text_offsets[1:] = np.cumsum([len(text) for text in encoded_texts])
+        blocks = [
+            zlib.compress(b"".join(encoded_texts[start : start + block_size]))
+            for start in range(0, len(encoded_texts), block_size)
+        ]
+        block_offsets = np.zeros(len(blocks) + 1, dtype=np.uint64)
+        block_offsets[1:] = np.cumsum([len(block) for block in blocks])
+        return cls(text_offsets, np.frombuffer(b"".join(blocks), dtype=np.uint8), block_offsets, block_size)
+
+    def __len__(self) -> int:
+        return len(self.text_offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.text_offsets.nbytes + self.data.nbytes + self.block_offsets.nbytes
+
+    def _block(self, block: int) -> bytes:
+        with self._lock:
+            if block in self._blocks:
+                self._blocks.move_to_end(block)
+                return self._blocks[block]
+        start, stop = int(self.block_offsets[block]), int(self.block_offsets[block + 1])
+        inflated = zlib.decompress(self.data[start:stop].tobytes())
+        with self._lock:
+            self._blocks[block] = inflated
+            while len(self._blocks) > _CACHED_BLOCKS:
+                self._blocks.popitem(last=False)
+        return inflated
+
+    def text(self, row: int) -> str:
+        start, stop = int(self.text_offsets[row]), int(self.text_offsets[row + 1])
+        block = row // self.block_size
+        base = int(self.text_offsets[block * self.block_size])
+        return self._block(block)[start - base : stop - base].decode("utf-8")
+
+
+class ChunkTexts:
+    """The texts of the chunks of an index. Every chunk refers to a row of one of the stores, so selecting and
+    combining indexes only combines these references, without reading or copying any text.
+    """
+
+    def __init__(self, stores: list[TextBlocks], store_ids: np.ndarray, rows: np.ndarray):
+        self.stores = stores
+        self.store_ids = store_ids
+        self.rows = rows
+        self._texts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_store(cls, store: TextBlocks) -> "ChunkTexts":
+        return cls([store], np.zeros(len(store), dtype=np.uint32), np.arange(len(store), dtype=np.int64))
+
+    @classmethod
+    def from_texts(cls, texts: Sequence[str]) -> "ChunkTexts":
+        return cls.from_store(TextBlocks.from_texts(texts))
+
+    @classmethod
+    def concatenate(cls, chunk_texts: Sequence["ChunkTexts"]) -> "ChunkTexts":
+        stores, store_ids = [], []
+        for texts in chunk_texts:
+            store_ids.append(texts.store_ids + np.uint32(len(stores)))
+            stores.extend(texts.stores)
+        return cls(stores, np.concatenate(store_ids), np.concatenate([texts.rows for texts in chunk_texts]))
+
+    def select(self, indices: np.ndarray) -> "ChunkTexts":
+        return ChunkTexts(self.stores, self.store_ids[indices], self.rows[indices])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def nbytes(self) -> int:
+        return self.store_ids.nbytes + self.rows.nbytes + sum(store.nbytes for store in self.stores)
+
+    def text(self, i: int) -> str:
+        with self._lock:
+            if i in self._texts:
+                self._texts.move_to_end(i)
+                return self._texts[i]
+        text = self.stores[self.store_ids[i]].text(int(self.rows[i]))
+        with self._lock:
+            self._texts[i] = text
+            while len(self._texts) > _CACHED_TEXTS:
+                self._texts.popitem(last=False)
+        return text
+
+    def to_store(self) -> TextBlocks:
+        """The texts as a single compressed store, as they are written to storage. Only a store that holds exactly
+        these texts is reused as is, any other selection of texts is compressed again.
+        """
+        if len(self.stores) == 1:
+            store = self.stores[0]
+            if len(store) == len(self) and np.array_equal(self.rows, np.arange(len(self))):
+                return store
+        return TextBlocks.from_texts(
+            [self.stores[store_id].text(int(row)) for store_id, row in zip(self.store_ids, self.rows)]
+        )
@@ -0,0 +1,135 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+class Trace:
+    """Durations and counters per stage of a job, e.g. answering a question or processing a PDF.
+
+    A stage that runs more than once, such as embedding the chunks of every page range, accumulates its durations and
+    counters. Stages can be recorded from several threads at once, and a stage includes the stages nested in it.
+    """
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.stages = {}
+        self.seconds = 0.0
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _stage(self, stage: str) -> dict:
+        return self.stages.setdefault(stage, {"seconds": 0.0, "calls": 0})
+
+    def add_time(self, stage: str, seconds: float, **counters):
+        """Add a duration that was measured elsewhere, e.g. in a worker process"""
+        with self._lock:
+            entry = self._stage(stage)
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            for counter, value in counters.items():
+                entry[counter] = entry.get(counter, 0) + value
+
+    def add_counts(self, stage: str, **counters):
+        with self._lock:
+            entry = self._stage(stage)
+            for counter, value in counters.items():
+                entry[counter] = entry.get(counter, 0) + value
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            stages = {
+                stage: {key: round(value, 4) if isinstance(value, float) else value for key, value in entry.items()}
+                for stage, entry in self.stages.items()
+            }
+        return {"trace": self.name, **self.attributes, "seconds": round(self.seconds, 4), "stages": stages}
+
+    def summary(self) -> str:
+        return ", ".join(f"{stage}: {entry['seconds']:.2f} s" for stage, entry in self.stages.items())
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace(name: str, **attributes) -> Iterator[Trace]:
+    """Collect the stages recorded within the block in a new trace, which is logged as JSON at the end"""
+    new_trace = Trace(name, **attributes)
+    token = _current_trace.set(new_trace)
+    try:
+        yield new_trace
+    finally:
+        _current_trace.reset(token)
+        new_trace.finish()
+        logger.info(json.dumps(new_trace.to_dict()))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a stage of the current trace. Counters recorded within the block are added to this stage."""
+    active_trace = _current_trace.get()
+    if active_trace is None:
+        yield
+        return
+    token = _current_stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+        active_trace.add_time(name, time.perf_counter() - start)
+
+
+def add_time(stage_name: str, seconds: float, **counters):
+    """Add a duration that was measured elsewhere, e.g. in a worker process, to a stage of the current trace"""
+    active_trace = _current_trace.get()
+    if active_trace is not None:
+        active_trace.add_time(stage_name, seconds, **counters)
+
+
+def record(**counters):
+    """Add counters, e.g. tokens or requests, to the current stage of the current trace"""
+    active_trace = _current_trace.get()
+    if active_trace is not None:
+        active_trace.add_counts(_current_stage.get() or "other", **counters)
+
+
+def in_context(function: Callable) -> Callable:
+    """Bind a function to the current trace and stage, to run it in other threads, e.g. with an executor"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can be entered by one thread at a time, so every call runs in its own copy
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
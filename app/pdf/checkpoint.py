@@ -0,0 +1,85 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+from viktor.core import Storage
+
+from app.AI_search.config import EMBEDDINGS_MODEL
+from app.AI_search.config import INGEST_CHECKPOINT_CHUNKS
+from app.AI_search.index_storage import ChunkIndex
+from app.AI_search.index_storage import read_index
+
+
+class IngestCheckpoint:
+    """Embedded chunks of a PDF that is being processed, saved to the entity storage in batches.
+
+    The batches are keyed by the hash of the document and the index of their first chunk. When the processing of the
+    same document is retried after a failure, the chunks in the saved batches are not embedded again. A saved chunk is
+    only reused when its text matches, so a change in e.g. the chunk size simply leads to new embeddings.
+    """
+
+    def __init__(self, document_hash: str, batch_size: int = INGEST_CHECKPOINT_CHUNKS):
+        self.prefix = f"ingest_checkpoint_{document_hash[:16]}_"
+        self.batch_size = batch_size
+        self.saved = {}
+        self._pending = []
+        self._pending_start = 0
+
+    def load(self) -> int:
+        """Load the batches saved by an earlier attempt. Returns the number of chunks they hold."""
+        for key, file in Storage().list(prefix=self.prefix, scope="entity").items():
+            self.saved[int(key[len(self.prefix) :])] = read_index(file, EMBEDDINGS_MODEL)
+        return sum(len(index) for index in self.saved.values())
+
+    def lookup(self, first_chunk: int, texts: Sequence[str]) -> list[Optional[np.ndarray]]:
+        """Saved embeddings of the chunks starting at first_chunk, or None for the chunks that were not saved"""
+        embeddings = [None] * len(texts)
+        for start, index in self.saved.items():
+            for i in range(max(start, first_chunk), min(start + len(index), first_chunk + len(texts))):
+                row = i - start
+                if index.text(row) == texts[i - first_chunk]:
+                    embeddings[i - first_chunk] = index.embeddings[row].astype(np.float32) * index.norms[row]
+        return embeddings
+
+    def add(self, first_chunk: int, index: ChunkIndex):
+        """Add newly embedded chunks, which are saved once a full batch has been collected"""
+        if first_chunk != self._pending_start + sum(len(pending) for pending in self._pending):
+            # A batch only holds consecutive chunks
+            self.save()
+        if not self._pending:
+            self._pending_start = first_chunk
+        self._pending.append(index)
+        if sum(len(pending) for pending in self._pending) >= self.batch_size:
+            self.save()
+
+    def save(self):
+        if not self._pending:
+            return
+        index = ChunkIndex.concatenate(self._pending)
+        Storage().set(f"{self.prefix}{self._pending_start:07d}", index.to_file(), scope="entity")
+        self.saved[self._pending_start] = index
+        self._pending = []
+
+    def clear(self):
+        """Remove the saved batches once the document has been processed completely"""
+        for start in self.saved:
+            try:
+                Storage().delete(f"{self.prefix}{start:07d}", scope="entity")
+            except FileNotFoundError:
+                pass
+        self.saved = {}
@@ -0,0 +1,113 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator
+
+from pypdf import PdfReader
+from viktor import File
+
+from app.AI_search.config import CHUNK_OVERLAP
+from app.AI_search.config import CHUNK_SIZE
+from app.AI_search.config import PDF_EXTRACTION_WORKERS
+from app.AI_search.config import PDF_PAGES_PER_TASK
+from app.AI_search.tracing import add_time
+from app.AI_search.tracing import stage
+
+from .text_splitter import RecursiveTextSplitter
+
+
+@contextmanager
+def local_path(file: File) -> Iterator[str]:
+    """Path of the file on local disk, so worker processes can open it. Files that are not on disk yet are spooled to
+    a temporary file, which is removed afterwards.
+    """
+    if file.source_type == File.SourceType.PATH:
+        yield file.source
+        return
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as spool:
+        with file.open_binary() as source:
+            shutil.copyfileobj(source, spool, length=1 << 20)
+        spool.flush()
+        yield spool.name
+
+
+def extract_page_range(pdf_path: str, start: int, stop: int, source: str) -> tuple[list[dict], float, float]:
+    """Extract and split the text of the pages start up to stop. Runs in a worker process. Returns the chunks, and the
+    time spent on parsing the PDF and on splitting the text.
+    """
+    # Splitter is used to chunk the document, so the chunk size doesn't become too big for AzureAI
+    splitter = RecursiveTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=["\n"])
+    parse_seconds = 0.0
+    split_seconds = 0.0
+    start_time = time.perf_counter()
+    reader = PdfReader(pdf_path)
+    chunks = []
+    for page_number in range(start, stop):
+        text = reader.pages[page_number].extract_text()
+        split_time = time.perf_counter()
+        parse_seconds += split_time - start_time
+        for split_text in splitter.split_text(text):
+            chunks.append({"text": split_text, "page_number": page_number + 1, "source": source})
+        start_time = time.perf_counter()
+        split_seconds += start_time - split_time
+    return chunks, parse_seconds, split_seconds
+
+
+def _collect(result: tuple[list[dict], float, float]) -> list[dict]:
+    """Add the time the workers spent on a page range to the current trace, and return its chunks"""
+    chunks, parse_seconds, split_seconds = result
+    add_time("pdf parsing (worker time)", parse_seconds)
+    add_time("text splitting (worker time)", split_seconds, chunks=len(chunks))
+    return chunks
+
+
+def extract_chunks(
+    pdf_path: str, source: str, max_workers: int = PDF_EXTRACTION_WORKERS, pages_per_task: int = PDF_PAGES_PER_TASK
+) -> Iterator[list[dict]]:
+    """Extract the chunks of a PDF as a stream of page ranges, in page order.
+
+    The page ranges are divided over a pool of worker processes. Only a few ranges per worker are extracted ahead of
+    the consumer, so the consumer (e.g. the embedding of the chunks) runs in parallel with the extraction while the
+    memory use does not depend on the size of the document.
+    """
+    n_pages = len(PdfReader(pdf_path).pages)
+    page_ranges = [(start, min(start + pages_per_task, n_pages)) for start in range(0, n_pages, pages_per_task)]
+    if len(page_ranges) <= 1 or max_workers <= 1:
+        for start, stop in page_ranges:
+            with stage("extraction"):
+                chunks = _collect(extract_page_range(pdf_path, start, stop, source))
+            yield chunks
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = []
+        page_ranges = iter(page_ranges)
+        for start, stop in page_ranges:
+            pending.append(executor.submit(extract_page_range, pdf_path, start, stop, source))
+            if len(pending) >= 2 * max_workers:
+                break
+        while pending:
+            # Only the time the consumer waits for the workers is part of the extraction stage
+            with stage("extraction"):
+                chunks = _collect(pending.pop(0).result())
+            next_range = next(page_ranges, None)
+            if next_range is not None:
+                pending.append(executor.submit(extract_page_range, pdf_path, *next_range, source))
+            yield chunks
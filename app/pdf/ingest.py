@@ -0,0 +1,89 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+
+from viktor import File
+from viktor.core import Storage
+from viktor.core import UserMessage
+
+from app.AI_search.config import EMBEDDINGS_MODEL
+from app.AI_search.embedding_cache import EmbeddingCache
+from app.AI_search.helper_functions import BatchEmbedder
+from app.AI_search.helper_functions import file_hash
+from app.AI_search.helper_functions import get_client
+from app.AI_search.index_storage import ChunkIndex
+from app.AI_search.tracing import stage
+from app.AI_search.tracing import trace
+
+from .checkpoint import IngestCheckpoint
+from .extraction import extract_chunks
+from .extraction import local_path
+
+
+def ingest_pdf(pdf_file: File, source: str) -> ChunkIndex:
+    """Extract, chunk and embed the text of a PDF and store the index of its chunks in the storage of the current
+    entity, together with the version of the document.
+    """
+    with trace("process_file", source=source):
+        cache = EmbeddingCache()
+        embedder = BatchEmbedder(get_client(), cache=cache)
+
+        # The chunks of all page ranges are embedded by one pool of requests, while the next ranges are being extracted
+        UserMessage.info(f"Extracting and embedding the text of {source}")
+        indexes = []
+        with local_path(pdf_file) as pdf_path:
+            with stage("download"):
+                document_hash = file_hash(File.from_path(pdf_path))
+            with stage("checkpoint"):
+                checkpoint = IngestCheckpoint(document_hash)
+                n_resumed = checkpoint.load()
+            if n_resumed:
+                UserMessage.info(f"Resuming the processing of {source}, {n_resumed} chunks were embedded before")
+
+            def page_ranges():
+                """The chunks of every page range with the texts that are not in the checkpoint"""
+                first_chunk = 0
+                for chunks in extract_chunks(pdf_path, source):
+                    texts = [chunk["text"] for chunk in chunks]
+                    embeddings = checkpoint.lookup(first_chunk, texts)
+                    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+                    yield (first_chunk, chunks, embeddings, missing), [texts[i] for i in missing]
+                    first_chunk += len(chunks)
+
+            with stage("embedding"):
+                for (first_chunk, chunks, embeddings, missing), new in embedder.embed_stream(page_ranges()):
+                    for i, embedding in zip(missing, new):
+                        embeddings[i] = embedding
+                    for chunk, embedding in zip(chunks, embeddings):
+                        chunk["embeddings"] = embedding
+                    index = ChunkIndex.from_records(chunks, EMBEDDINGS_MODEL)
+                    if missing:
+                        with stage("checkpoint"):
+                            checkpoint.add(first_chunk, index)
+                    indexes.append(index)
+        with stage("embedding cache"):
+            cache.flush()
+        UserMessage.info(embedder.summary())
+        UserMessage.info(cache.summary())
+
+        with stage("index upload"):
+            index = ChunkIndex.concatenate(indexes) if indexes else ChunkIndex.from_records([], EMBEDDINGS_MODEL)
+            Storage().set("pdf_storage", index.to_file(), scope="entity")
+            # The version is used by the project to detect which documents changed since its index was last built
+            pdf_version = {"document_hash": document_hash, "model": EMBEDDINGS_MODEL, "n_chunks": len(index)}
+            Storage().set("pdf_version", File.from_data(json.dumps(pdf_version)), scope="entity")
+        with stage("checkpoint"):
+            checkpoint.clear()
+        return index
@@ -0,0 +1,94 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import re
+from typing import Sequence
+
+
+class RecursiveTextSplitter:
+    """Splits text into chunks of at most chunk_size characters, on the first separator that occurs in the text.
+
+    Pieces that are still too long are split again on the next separator. The pieces are then merged into chunks,
+    where consecutive chunks share up to chunk_overlap characters of whole pieces. The separators are kept at the start
+    of the piece that follows them and the chunks are stripped of surrounding whitespace. This is the behaviour of the
+    RecursiveCharacterTextSplitter of langchain, which was used before.
+    """
+
+    def __init__(self, chunk_size: int, chunk_overlap: int, separators: Sequence[str] = ("\n\n", "\n", " ", "")):
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"The chunk overlap ({chunk_overlap}) should be smaller than the chunk size ({chunk_size})"
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = list(separators)
+
+    def split_text(self, text: str) -> list[str]:
+        return self._split(text, self.separators)
+
+    def _split(self, text: str, separators: list[str]) -> list[str]:
+        separator = separators[-1]
+        remaining_separators = []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if candidate in text:
+                separator = candidate
+                remaining_separators = separators[i + 1 :]
+                break
+
+        chunks = []
+        short_pieces = []
+        for piece in _split_keeping_separator(text, separator):
+            if len(piece) < self.chunk_size:
+                short_pieces.append(piece)
+                continue
+            if short_pieces:
+                chunks.extend(self._merge(short_pieces))
+                short_pieces = []
+            if remaining_separators:
+                chunks.extend(self._split(piece, remaining_separators))
+            else:
+                chunks.append(piece)
+        if short_pieces:
+            chunks.extend(self._merge(short_pieces))
+        return chunks
+
+    def _merge(self, pieces: list[str]) -> list[str]:
+        """Merge pieces into chunks of at most chunk_size characters. A new chunk starts with the last pieces of the
+        previous chunk, as long as they fit in the overlap.
+        """
+        chunks = []
+        current = []
+        total = 0
+        for piece in pieces:
+            if current and total + len(piece) > self.chunk_size:
+                chunks.append("".join(current).strip())
+                while total > self.chunk_overlap or (total + len(piece) > self.chunk_size and total > 0):
+                    total -= len(current.pop(0))
+            current.append(piece)
+            total += len(piece)
+        chunks.append("".join(current).strip())
+        return [chunk for chunk in chunks if chunk]
+
+
+def _split_keeping_separator(text: str, separator: str) -> list[str]:
+    """Split the text on the separator, keeping each separator at the start of the piece that follows it"""
+    if not separator:
+        return list(text)
+    parts = re.split(f"({re.escape(separator)})", text)
+    pieces = [parts[0]] + [parts[i] + parts[i + 1] for i in range(1, len(parts), 2)]
+    return [piece for piece in pieces if piece]
@@ -12,29 +12,32 @@ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFT
 SOFTWARE.
 """
 
-import pickle
+import json
 
-import numpy as np
-import pandas as pd
 from viktor import UserError
 from viktor import UserMessage
 from viktor import ViktorController
 from viktor.api_v1 import API
 from viktor.core import File
 from viktor.core import Storage
+from viktor.result import DownloadResult
 from viktor.result import SetParamsResult
 from viktor.views import WebResult
 from viktor.views import WebView
 
 from app.project.parametrization import Parametrization
 
-from ..AI_search.chat_view import generate_html_code
-from ..AI_search.chat_view import list_to_html_string
-from ..AI_search.retrieval_assistant import RetrievalAssistant
+from ..AI_search.config import SHOW_TIMINGS
+from ..AI_search.tracing import stage
+from ..AI_search.tracing import trace
 
 
 class Controller(ViktorController):
-    """Controller class for Document searcher app"""
+    """Controller class for Document searcher app
+
+    The modules for the search are imported in the methods that use them, so the app starts without loading openai,
+    numpy and the PDF libraries, and views like the document list do not need them at all.
+    """
 
     label = "Documents"
     parametrization = Parametrization
@@ -42,44 +45,97 @@ class Controller(ViktorController):
     show_children_as = "Table"
 
     def set_embeddings(self, params, entity_id, **kwargs):
-        """Takes in one or multiple PDF documents and returns a single chunked, embedded file. The metadata for page
-        number and document name is included in the embedded file. The embedded file is saved to storage.
+        """Takes in one or multiple PDF documents and updates the chunked, embedded index of the project. Only the
+        documents that were added, replaced or removed since the previous submit are processed. The metadata for page
+        number and document name is included in the index. The index is saved to storage.
         """
-        df_list = []
-        pdf_names = []
+        from ..AI_search.chat_view import list_to_html_string  # pylint: disable=import-outside-toplevel
+        from ..AI_search.index_cache import index_cache  # pylint: disable=import-outside-toplevel
+        from ..AI_search.project_index import count_chunks  # pylint: disable=import-outside-toplevel
+        from ..AI_search.project_index import update_project_index  # pylint: disable=import-outside-toplevel
+
         current_entity = API().get_entity(entity_id)
         pdf_entities = current_entity.children()
         if not pdf_entities:
             raise UserError("Please upload your PDF documents first")
-        for pdf_file_entity in pdf_entities:
-            UserMessage.info(f"Receiving data for {pdf_file_entity.name}")
-            df = pickle.loads(Storage().get("pdf_storage", scope="entity", entity=pdf_file_entity).getvalue_binary())
-            df_list.append(df)
-            pdf_names.append(pdf_file_entity.name)
-        combined_df = pd.concat(df_list, ignore_index=True)
-        combined_df["embeddings"] = combined_df["embeddings"].apply(np.array)
+        with trace("set_embeddings", entity_id=entity_id):
+            manifest = update_project_index(pdf_entities)
+        index_cache.invalidate(entity_id)
+        if not count_chunks(manifest):
+            raise UserError("No text could be extracted from the uploaded PDF documents, so there is nothing to search")
         UserMessage.success("Document succesfully embedded!")
-        pdf_names_str = list_to_html_string(pdf_names)
-        viktor_file = File()
-        with viktor_file.open_binary() as f:
-            combined_df.to_pickle(f)
-        Storage().set("embeddings_storage", viktor_file, scope="entity")
+        pdf_names_str = list_to_html_string([pdf_file_entity.name for pdf_file_entity in pdf_entities])
         Storage().set("list_of_files", File.from_data(pdf_names_str), scope="entity")
         return SetParamsResult({"input": {"embeddings_are_set": True}})
 
+    @staticmethod
+    def _search_filter(params, index):
+        """Rows of the index selected by the document and page filters, or None when there is no filter, together with
+        the answer cache for that selection
+        """
+        from ..AI_search.answer_cache import AnswerCache  # pylint: disable=import-outside-toplevel
+
+        if not len(index):
+            raise UserError("The uploaded PDF documents contain no text to search, please upload documents with text")
+        documents = sorted(params.input.documents or [])
+        first_page, last_page = params.input.first_page, params.input.last_page
+        rows = index.filter_rows(documents, first_page, last_page)
+        if rows is None:
+            return None, AnswerCache(index.version)
+        if not len(rows):
+            raise UserError("None of the selected documents has text on the selected pages")
+        return rows, AnswerCache(index.version, scope=json.dumps([documents, first_page, last_page]))
+
     @WebView("Conversation", duration_guess=5)
-    def conversation(self, params, **kwargs):
+    def conversation(self, params, entity_id, **kwargs):
         """View for showing the questions, answers and sources to the user."""
         if not params.input.embeddings_are_set:
             raise UserError("Please embed the uploaded PDF file first, by clicking 'Submit document(s)'.")
-        df = pickle.loads(Storage().get("embeddings_storage", scope="entity").getvalue_binary())
-        retrieval_assistant = RetrievalAssistant(params.input.question, df)
-        answer = retrieval_assistant.ask_assistant()
+        from ..AI_search.chat_view import generate_html_code  # pylint: disable=import-outside-toplevel
+        from ..AI_search.project_index import get_project_index  # pylint: disable=import-outside-toplevel
+        from ..AI_search.retrieval_assistant import RetrievalAssistant  # pylint: disable=import-outside-toplevel
+
+        with trace("conversation", entity_id=entity_id) as conversation_trace:
+            with stage("index loading"):
+                index = get_project_index(entity_id)
+                rows, answer_cache = self._search_filter(params, index)
+            retrieval_assistant = RetrievalAssistant(params.input.question, index, answer_cache, rows)
+            answer = retrieval_assistant.ask_assistant()
         html = generate_html_code(
-            params.input.question, answer, retrieval_assistant.metadata_list, retrieval_assistant.context_list
+            params.input.question,
+            answer,
+            retrieval_assistant.metadata_list,
+            retrieval_assistant.context_list,
+            conversation_trace if SHOW_TIMINGS else None,
         )
         return WebResult(html=html)
 
+    @classmethod
+    def _answer_batch(cls, params, entity_id) -> list[dict]:
+        from ..AI_search.batch_questions import BatchAssistant  # pylint: disable=import-outside-toplevel
+        from ..AI_search.batch_questions import parse_questions  # pylint: disable=import-outside-toplevel
+        from ..AI_search.project_index import get_project_index  # pylint: disable=import-outside-toplevel
+
+        if not params.input.embeddings_are_set:
+            raise UserError("Please embed the uploaded PDF file first, by clicking 'Submit document(s)'.")
+        questions = parse_questions(params.batch.questions)
+        index = get_project_index(entity_id)
+        rows, answer_cache = cls._search_filter(params, index)
+        return BatchAssistant(questions, index, answer_cache, rows=rows).answer_all()
+
+    @WebView("Batch answers", duration_guess=60)
+    def batch_answers(self, params, entity_id, **kwargs):
+        """View for showing the answers to a list of questions in a single table."""
+        from ..AI_search.chat_view import generate_batch_html  # pylint: disable=import-outside-toplevel
+
+        return WebResult(html=generate_batch_html(self._answer_batch(params, entity_id)))
+
+    def download_batch_report(self, params, entity_id, **kwargs):
+        """Download the answers to a list of questions, with their sources, as a CSV report."""
+        from ..AI_search.batch_questions import batch_report_csv  # pylint: disable=import-outside-toplevel
+
+        return DownloadResult(batch_report_csv(self._answer_batch(params, entity_id)), "answers.csv")
+
     @WebView("Document list", duration_guess=1)
     def document_list_view(self, params, **kwargs):
         """View for showing which documents are currently embedded in storage and used to answer the questions."""
@@ -12,8 +12,13 @@ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFT
 SOFTWARE.
 """
 
+from viktor.api_v1 import API
 from viktor.parametrization import BooleanField
 from viktor.parametrization import ChildEntityManager
+from viktor.parametrization import DownloadButton
+from viktor.parametrization import IntegerField
+from viktor.parametrization import MultiSelectField
+from viktor.parametrization import OptionListElement
 from viktor.parametrization import SetParamsButton
 from viktor.parametrization import Tab
 from viktor.parametrization import Text
@@ -21,6 +26,14 @@ from viktor.parametrization import TextAreaField
 from viktor.parametrization import ViktorParametrization
 
 
+def document_options(params, entity_id, **kwargs) -> list[OptionListElement]:
+    """The PDF documents of the project, by the source name that is stored with their chunks"""
+    return [
+        OptionListElement(pdf_entity.name.split(".")[0], pdf_entity.name)
+        for pdf_entity in API().get_entity(entity_id).children()
+    ]
+
+
 class Parametrization(ViktorParametrization):
     """Parametrization class for document searcher"""
 
@@ -40,10 +53,25 @@ class Parametrization(ViktorParametrization):
         flex=100,
         description="Any language is allowed, the app will answer in the same language as your question.",
     )
+    input.filter_text = Text(
+        "Optionally, only search in some of the documents or in a range of pages. Leave these fields empty to search "
+        "all documents."
+    )
+    input.documents = MultiSelectField("Documents", options=document_options, flex=100)
+    input.first_page = IntegerField("First page", min=1, flex=45)
+    input.last_page = IntegerField("Last page", min=1, flex=45)
     input.step_4_text = Text("**Step 4:** Get your result by clicking 'Update' in the lower-right corner of this app.")
 
     input.embeddings_are_set = BooleanField("embeddings_are_set", default=False, visible=False)
 
+    batch = Tab("Batch questions")
+    batch.intro_text = Text(
+        "Answer a list of questions at once, for example a checklist. The answers and their sources are shown in the "
+        "'Batch answers' view, and can be downloaded as a report."
+    )
+    batch.questions = TextAreaField("Questions, one per line", flex=100)
+    batch.download_report = DownloadButton("Download report", "download_batch_report", longpoll=True, flex=45)
+
     privacy_info = Tab("\U0001f4da Privacy & Usage info")
     privacy_info.disclaimer_text = Text(
         """
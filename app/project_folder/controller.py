@@ -12,12 +12,44 @@ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFT
 SOFTWARE.
 """
 
+from viktor import UserError
 from viktor import ViktorController
+from viktor.api_v1 import API
+from viktor.views import WebResult
+from viktor.views import WebView
+
+from ..AI_search.config import SHOW_TIMINGS
+from ..AI_search.tracing import trace
+from .parametrization import Parametrization
 
 
 class Controller(ViktorController):
     """Controller for project folder"""
 
     label = "Projects"
+    parametrization = Parametrization
     children = ["Project"]
     show_children_as = "Table"
+
+    @WebView("Conversation", duration_guess=10)
+    def conversation(self, params, entity_id, **kwargs):
+        """View for answering a question from the documents of all projects in the folder, with their sources."""
+        if not params.question:
+            raise UserError("Please ask a question first")
+        from ..AI_search.chat_view import generate_html_code  # pylint: disable=import-outside-toplevel
+        from ..AI_search.federated import FederatedAssistant  # pylint: disable=import-outside-toplevel
+
+        projects = API().get_entity(entity_id).children()
+        if not projects:
+            raise UserError("Please create a project with documents first")
+        with trace("folder_conversation", entity_id=entity_id, n_projects=len(projects)) as conversation_trace:
+            federated_assistant = FederatedAssistant(params.question, list(projects))
+            answer = federated_assistant.ask_assistant()
+        html = generate_html_code(
+            params.question,
+            answer,
+            federated_assistant.metadata_list,
+            federated_assistant.context_list,
+            conversation_trace if SHOW_TIMINGS else None,
+        )
+        return WebResult(html=html)
@@ -0,0 +1,33 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from viktor.parametrization import Text
+from viktor.parametrization import TextAreaField
+from viktor.parametrization import ViktorParametrization
+
+
+class Parametrization(ViktorParametrization):
+    """Parametrization class for searching all projects of a folder"""
+
+    intro_text = Text(
+        "# \U0001F50D Search all projects  \n"
+        "Ask a question about the submitted documents of all projects in this folder, for example a library of "
+        "standards. The sources of the answer name the project they come from."
+    )
+    question = TextAreaField(
+        "Ask your question here",
+        flex=100,
+        description="Any language is allowed, the app will answer in the same language as your question.",
+    )
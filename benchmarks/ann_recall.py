@@ -0,0 +1,75 @@
+"""Recall versus latency of the approximate nearest neighbour search, compared to exact search on the same data.
+
+Run from the root of the repository, either on synthetic clustered embeddings:
+
+    python -m benchmarks.ann_recall --chunks 50000
+
+or on a stored index (a downloaded pdf_storage or embeddings_segment file):
+
+    python -m benchmarks.ann_recall --index path/to/index
+"""
+
+import argparse
+import math
+
+import numpy as np
+from viktor.core import File
+
+from app.AI_search.ann import ANNSearcher
+from app.AI_search.ann import IVFIndex
+from app.AI_search.ann import recall_report
+from app.AI_search.config import EMBEDDINGS_MODEL
+from app.AI_search.index_storage import ChunkIndex
+from app.AI_search.index_storage import read_index
+
+
+def synthetic_index(n_chunks: int, dimension: int, n_topics: int, seed: int = 0) -> ChunkIndex:
+    """Embeddings scattered around a number of topics, which resembles the structure of real document embeddings"""
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(n_topics, dimension))
+    embeddings = topics[rng.integers(n_topics, size=n_chunks)] + 1.2 * rng.normal(size=(n_chunks, dimension))
+    records = [
+        {"text": f"chunk {i}", "embeddings": embedding, "page_number": i // 2 + 1, "source": "synthetic"}
+        for i, embedding in enumerate(embeddings)
+    ]
+    return ChunkIndex.from_records(records, EMBEDDINGS_MODEL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", help="Stored index to benchmark, instead of synthetic embeddings")
+    parser.add_argument("--chunks", type=int, default=50_000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=20)
+    parser.add_argument("--probe-fraction", type=float, nargs="+", default=[0.01, 0.02, 0.05, 0.1, 0.2])
+    args = parser.parse_args()
+
+    if args.index:
+        index = read_index(File.from_path(args.index), EMBEDDINGS_MODEL)
+    else:
+        index = synthetic_index(args.chunks, args.dimension, args.topics)
+    # The rows are put in the order of the IVF lists, as they are stored in a project index
+    ivf_index = IVFIndex.train(index.embeddings)
+    index = index.select(ivf_index.list_rows)
+    index.ann = ANNSearcher([ivf_index], np.empty(0, dtype=np.int64), index.embeddings)
+
+    # Queries are perturbed chunks, like a question is close to, but not the same as, the chunk answering it
+    rng = np.random.default_rng(1)
+    rows = rng.choice(len(index), args.queries, replace=False)
+    queries = index.embeddings[rows].astype(np.float32) + 0.05 * rng.normal(size=(args.queries, index.dimension))
+
+    n_lists = len(index.ann.ivf_indexes[0].centroids)
+    print(f"{len(index)} chunks, {index.dimension} dimensions, {n_lists} IVF lists, recall@{args.k}")
+    print(f"{'fraction':>8} {'lists':>6} {'recall':>8} {'ms/query':>10}")
+    for row in recall_report(index, queries, args.k, args.probe_fraction):
+        if row["probe_fraction"] is None:
+            fraction, n_probed = "exact", n_lists
+        else:
+            fraction, n_probed = row["probe_fraction"], max(math.ceil(row["probe_fraction"] * n_lists), 1)
+        print(f"{fraction:>8} {n_probed:>6} {row['recall']:>8.3f} {row['latency_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""End-to-end benchmark of the upload, submit and question paths, against a local stand-in for AzureAI.
+
+Synthetic PDFs are processed like ProcessPDF.process_file does, submitted with Project.set_embeddings and then
+questions are asked through the Conversation view. The platform storage is kept in memory. Run from the root of the
+repository:
+
+    python -m benchmarks.end_to_end --documents 4 --pages 100 --questions 50 --latency-ms 20 --throttle-rate 0.02
+
+By default the configured AzureAI quota is applied, as in production. Use --no-quota to measure the app itself.
+"""
+
+import argparse
+import logging
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+
+from munch import Munch
+from viktor.core import File
+
+from benchmarks.fake_azure import FakeAzure
+from benchmarks.fake_azure import FakeAzureServer
+from benchmarks.local_platform import LocalPlatform
+from benchmarks.synthetic_pdf import document_text
+from benchmarks.synthetic_pdf import write_pdf
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=50, help="Pages per document")
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--no-quota", action="store_true", help="Do not apply the configured AzureAI quota")
+    parser.add_argument("--traces", action="store_true", help="Print the trace of every upload, submit and question")
+    args = parser.parse_args()
+    if args.traces:
+        logging.basicConfig(format="%(message)s")
+        logging.getLogger("app.AI_search.tracing").setLevel(logging.INFO)
+
+    fake = FakeAzure(args.dimension, args.latency_ms / 1000, args.throttle_rate)
+    with FakeAzureServer(fake) as server, tempfile.TemporaryDirectory() as directory:
+        os.environ.update(API_KEY="benchmark", ENDPOINT=server.endpoint, API_VERSION="2023-05-15")
+        # Imported here, so the app reads the configuration of the fake deployment
+        from app.AI_search import helper_functions  # pylint: disable=import-outside-toplevel
+        from app.AI_search.project_index import load_project_index  # pylint: disable=import-outside-toplevel
+        from app.AI_search.rate_limiter import RateLimiter  # pylint: disable=import-outside-toplevel
+        from app.pdf.ingest import ingest_pdf  # pylint: disable=import-outside-toplevel
+        from app.project.controller import Controller as Project  # pylint: disable=import-outside-toplevel
+
+        if args.no_quota:
+            helper_functions.embeddings_rate_limiter = RateLimiter(10**9, 10**12)
+            helper_functions.completions_rate_limiter = RateLimiter(10**9, 10**12)
+        platform = LocalPlatform()
+        platform.install()
+        project = platform.create_entity("Benchmark project")
+
+        # Upload
+        ingest_seconds = 0.0
+        all_pages = []
+        for document in range(args.documents):
+            pages = document_text(args.pages, seed=document)
+            all_pages.extend(pages)
+            path = os.path.join(directory, f"document_{document}.pdf")
+            write_pdf(path, pages)
+            pdf_entity = platform.create_entity(f"document_{document}.pdf", parent=project)
+            with platform.as_entity(pdf_entity):
+                start = time.perf_counter()
+                # The upload handler of the SDK needs the platform, so the function it calls is run directly
+                ingest_pdf(File.from_path(path), f"document_{document}")
+                ingest_seconds += time.perf_counter() - start
+        n_requests_ingest = fake.n_embedding_requests
+
+        # Submit
+        with platform.as_entity(project):
+            start = time.perf_counter()
+            Project().set_embeddings(Munch(), project.id)
+            submit_seconds = time.perf_counter() - start
+        with platform.as_entity(project):
+            n_chunks = len(load_project_index()[0])
+        index_bytes = platform.storage_size(project, "embeddings_")
+
+        # Questions, each about a random line of the documents
+        rng = random.Random(1)
+        latencies = []
+        for _ in range(args.questions):
+            line = rng.choice(rng.choice(all_pages)[1:])
+            question = "What is said about " + " ".join(line.rstrip(".").split()[:6]).lower() + "?"
+            params = Munch(
+                input=Munch(embeddings_are_set=True, question=question, documents=[], first_page=None, last_page=None)
+            )
+            with platform.as_entity(project):
+                start = time.perf_counter()
+                Project.conversation(Project(), params=params, entity_id=project.id)
+                latencies.append(time.perf_counter() - start)
+
+    own_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    worker_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"Documents:        {args.documents} x {args.pages} pages, {n_chunks} chunks")
+    print(
+        f"Upload:           {ingest_seconds:.2f} s, {n_chunks / ingest_seconds:.1f} chunks/s, "
+        f"{n_requests_ingest} requests"
+    )
+    print(f"Submit:           {submit_seconds:.2f} s")
+    print(f"Index size:       {index_bytes / 1024**2:.1f} MB")
+    print(
+        f"Question latency: p50 {statistics.median(latencies) * 1000:.0f} ms, "
+        f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, first {latencies[0] * 1000:.0f} ms"
+    )
+    print(f"Peak RSS:         {own_rss:.0f} MB, extraction workers {worker_rss:.0f} MB")
+    print(
+        f"Fake AzureAI:     {fake.n_embedding_requests} embedding requests, {fake.n_completion_requests} completions, "
+        f"{fake.n_throttled} throttled"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Local stand-in for the AzureAI embeddings and chat completions deployments, for benchmarks without a live deployment.
+
+Embeddings are deterministic: the embedding of a text is the normalized sum of a pseudo-random vector per word, so
+texts that share words get similar embeddings and questions retrieve the chunks that contain their words. Every
+response can be delayed, and a fraction of the requests can be answered with 429 and a retry-after header, like a
+deployment that is over its quota.
+
+Run standalone, e.g. to try the app locally against it:
+
+    python -m benchmarks.fake_azure --port 8089 --latency-ms 50 --throttle-rate 0.05
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+
+_WORD = re.compile(r"\w+")
+
+
+class FakeAzure:
+    """Embeddings and completions as the fake server returns them, with counters of the handled requests"""
+
+    def __init__(self, dimension: int = 1536, latency: float = 0.0, throttle_rate: float = 0.0, seed: int = 0):
+        self.dimension = dimension
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.n_embedding_requests = 0
+        self.n_completion_requests = 0
+        self.n_throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._word_vector = lru_cache(maxsize=100_000)(self._new_word_vector)
+
+    def _new_word_vector(self, word: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+        return np.random.default_rng(seed).standard_normal(self.dimension, dtype=np.float32)
+
+    def embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in _WORD.findall(text.lower()):
+            vector += self._word_vector(word)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def throttle(self) -> bool:
+        """Whether the next request is rejected with 429"""
+        with self._lock:
+            throttled = self._random.random() < self.throttle_rate
+            self.n_throttled += throttled
+            return throttled
+
+    def embeddings_response(self, body: dict, model: str) -> dict:
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        with self._lock:
+            self.n_embedding_requests += 1
+        n_tokens = sum(len(text.split()) for text in texts)
+        return {
+            "object": "list",
+            "model": model,
+            "data": [
+                {"object": "embedding", "index": i, "embedding": self.embed(text)} for i, text in enumerate(texts)
+            ],
+            "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+        }
+
+    def completions_response(self, body: dict, model: str) -> dict:
+        with self._lock:
+            self.n_completion_requests += 1
+        question = body["messages"][0]["content"].strip().splitlines()[0]
+        answer = f"This is a generated answer to: {question[:200]}"
+        n_tokens = sum(len(message["content"].split()) for message in body["messages"])
+        return {
+            "id": f"chatcmpl-{self.n_completion_requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer}}],
+            "usage": {"prompt_tokens": n_tokens, "completion_tokens": 10, "total_tokens": n_tokens + 10},
+        }
+
+
+def _handler(fake: FakeAzure):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):  # pylint: disable=arguments-differ
+            pass
+
+        def _send(self, status: int, body: dict, headers: dict = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            match = re.match(r"/openai/deployments/([^/]+)/(embeddings|chat/completions)", self.path)
+            if match is None:
+                self._send(404, {"error": {"code": "404", "message": f"Unknown path {self.path}"}})
+                return
+            time.sleep(fake.latency)
+            if fake.throttle():
+                message = "Requests to the deployment have exceeded the rate limit, please retry after 1 second"
+                self._send(429, {"error": {"code": "429", "message": message}}, {"retry-after-ms": "200"})
+                return
+            model, endpoint = match.groups()
+            if endpoint == "embeddings":
+                self._send(200, fake.embeddings_response(body, model))
+            else:
+                self._send(200, fake.completions_response(body, model))
+
+    return Handler
+
+
+class FakeAzureServer:
+    """Runs the fake deployments on a local port, in a background thread, for the duration of a with block"""
+
+    def __init__(self, fake: FakeAzure, port: int = 0):
+        self.fake = fake
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), _handler(fake))
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> "FakeAzureServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    fake = FakeAzure(args.dimension, args.latency_ms / 1000, args.throttle_rate)
+    with FakeAzureServer(fake, args.port) as server:
+        print(f"Serving fake AzureAI deployments on {server.endpoint}, press Ctrl+C to stop")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Import time of the app entry point, checked against a budget. Exits with status 1 when the budget is exceeded or when
+importing the app loads one of the heavy dependencies, which should only be imported where they are used.
+
+Run from the root of the repository:
+
+    python -m benchmarks.import_time --budget-ms 50
+
+The import time of the VIKTOR SDK itself is measured separately and not counted in the budget.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ("httpx", "langchain", "markdown", "openai", "pandas", "pypdf", "tiktoken")
+
+_MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import viktor, viktor.api_v1, viktor.parametrization, viktor.result, viktor.views
+sdk = time.perf_counter()
+import app
+end = time.perf_counter()
+print(json.dumps({"sdk": sdk - start, "app": end - sdk, "modules": sorted(sys.modules)}))
+"""
+
+
+def measure(repeat: int) -> tuple[list[float], list[float], set[str]]:
+    """Import the app in fresh interpreters. Returns the SDK and app import times and the modules that were loaded."""
+    sdk_times = []
+    app_times = []
+    modules = set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", _MEASURE], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        sdk_times.append(result["sdk"])
+        app_times.append(result["app"])
+        modules.update(result["modules"])
+    return sdk_times, app_times, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    sdk_times, app_times, modules = measure(args.repeat)
+    app_ms = statistics.median(app_times) * 1000
+    print(f"VIKTOR SDK: {statistics.median(sdk_times) * 1000:.0f} ms, app: {app_ms:.0f} ms (median of {args.repeat})")
+    loaded = [module for module in HEAVY_MODULES if module in modules]
+    failed = False
+    if loaded:
+        print(f"FAIL: importing the app loads {', '.join(loaded)}")
+        failed = True
+    if app_ms > args.budget_ms:
+        print(f"FAIL: the app import takes longer than the budget of {args.budget_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""In-memory stand-ins for the storage and entity API of the VIKTOR platform, so the controllers can be run offline"""
+
+import importlib
+from contextlib import contextmanager
+
+from viktor.core import File
+
+# Modules of the app that use the storage or the entity API
+_MODULES = (
+    "app.AI_search.answer_cache",
+    "app.AI_search.embedding_cache",
+    "app.AI_search.project_index",
+    "app.pdf.checkpoint",
+    "app.pdf.ingest",
+    "app.project.controller",
+    "app.project_folder.controller",
+)
+
+
+class LocalEntity:
+    def __init__(self, platform: "LocalPlatform", entity_id: int, name: str, parent: "LocalEntity" = None):
+        self.platform = platform
+        self.id = entity_id
+        self.name = name
+        self.parent = parent
+
+    def children(self) -> list["LocalEntity"]:
+        return [entity for entity in self.platform.entities.values() if entity.parent is self]
+
+
+class LocalPlatform:
+    """Entities and their storage. Storage calls without an explicit entity use the entity set by as_entity."""
+
+    def __init__(self):
+        self.entities = {}
+        self.files = {}
+        self.current_entity = None
+
+    def create_entity(self, name: str, parent: LocalEntity = None) -> LocalEntity:
+        entity = LocalEntity(self, len(self.entities) + 1, name, parent)
+        self.entities[entity.id] = entity
+        return entity
+
+    @contextmanager
+    def as_entity(self, entity: LocalEntity):
+        """Run a controller method as the given entity"""
+        previous, self.current_entity = self.current_entity, entity
+        try:
+            yield
+        finally:
+            self.current_entity = previous
+
+    def storage_size(self, entity: LocalEntity, prefix: str = "") -> int:
+        return sum(
+            len(data)
+            for (scope, entity_id, key), data in self.files.items()
+            if scope == "entity" and entity_id == entity.id and key.startswith(prefix)
+        )
+
+    def storage(self):
+        platform = self
+
+        class Storage:
+            @staticmethod
+            def _key(key, scope, entity):
+                if scope == "workspace":
+                    return scope, None, key
+                return scope, (entity or platform.current_entity).id, key
+
+            def get(self, key, *, scope, entity=None) -> File:
+                try:
+                    return File.from_data(platform.files[self._key(key, scope, entity)])
+                except KeyError:
+                    raise FileNotFoundError(key)
+
+            def set(self, key, data: File, *, scope, entity=None):
+                platform.files[self._key(key, scope, entity)] = data.getvalue_binary()
+
+            def delete(self, key, *, scope, entity=None):
+                try:
+                    del platform.files[self._key(key, scope, entity)]
+                except KeyError:
+                    raise FileNotFoundError(key)
+
+            def list(self, *, prefix=None, scope, entity=None) -> dict:
+                scope, entity_id, _ = self._key("", scope, entity)
+                return {
+                    key: File.from_data(data)
+                    for (file_scope, file_entity_id, key), data in platform.files.items()
+                    if file_scope == scope and file_entity_id == entity_id and key.startswith(prefix or "")
+                }
+
+        return Storage
+
+    def api(self):
+        platform = self
+
+        class API:
+            def get_entity(self, entity_id: int) -> LocalEntity:
+                return platform.entities[entity_id]
+
+        return API
+
+    def install(self):
+        """Replace the storage and entity API in the modules of the app"""
+        for module_name in _MODULES:
+            module = importlib.import_module(module_name)
+            if hasattr(module, "Storage"):
+                module.Storage = self.storage()
+            if hasattr(module, "API"):
+                module.API = self.api()
@@ -0,0 +1,67 @@
+"""Synthetic PDF documents of configurable size, with extractable text, for the ingest benchmarks"""
+
+import random
+
+_VOCABULARY = (
+    "concrete cover reinforcement steel beam column slab foundation pile load wind snow seismic fire resistance "
+    "durability exposure class crack width deflection span support bearing joint anchor bolt weld plate girder "
+    "truss bracing stability buckling moment shear torsion tension compression stress strain modulus density "
+    "temperature moisture drainage insulation facade roof floor wall opening stair elevator shaft corridor "
+    "requirement specification tender contractor client engineer approval inspection testing tolerance "
+    "maintenance schedule phase drawing revision document section clause annex table figure value minimum maximum"
+).split()
+
+
+def document_text(n_pages: int, lines_per_page: int = 45, seed: int = 0) -> list[list[str]]:
+    """Lines of text per page, made of random sentences of a construction vocabulary"""
+    rng = random.Random(seed)
+    pages = []
+    for page_number in range(n_pages):
+        lines = [f"Section {page_number + 1}"]
+        for _ in range(lines_per_page - 1):
+            words = rng.choices(_VOCABULARY, k=rng.randint(8, 14))
+            lines.append(" ".join(words).capitalize() + ".")
+        pages.append(lines)
+    return pages
+
+
+def write_pdf(path: str, pages: list[list[str]]):
+    """Write a minimal PDF with one text object per page, in the standard Helvetica font"""
+    objects = []
+
+    def add(content: bytes) -> int:
+        objects.append(content)
+        return len(objects)
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pages_id = font + 2 * len(pages) + 1
+    kids = []
+    for lines in pages:
+        text = " ".join(f"({_escape(line)}) '" for line in lines)
+        stream = f"BT /F1 10 Tf 40 810 Td 12 TL {text} ET".encode("latin-1")
+        contents = add(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        kids.append(
+            add(
+                b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+                b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_id, contents, font)
+            )
+        )
+    add(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % kid for kid in kids), len(kids)))
+    catalog = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, content in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, content)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref)
+    with open(path, "wb") as file:
+        file.write(output)
+
+
+def _escape(line: str) -> str:
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
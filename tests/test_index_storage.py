@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from app.AI_search.config import EMBEDDINGS_MODEL
+from app.AI_search.deduplication import find_duplicates
+from app.AI_search.index_storage import ChunkIndex
+
+
+def make_index(pages_per_source: dict, dimension: int = 16, seed: int = 0) -> ChunkIndex:
+    """Index with one chunk per page number, with random embeddings"""
+    rng = np.random.default_rng(seed)
+    records = [
+        {
+            "text": f"{source} page {page}",
+            "embeddings": rng.normal(size=dimension),
+            "page_number": page,
+            "source": source,
+        }
+        for source, pages in pages_per_source.items()
+        for page in pages
+    ]
+    return ChunkIndex.from_records(records, EMBEDDINGS_MODEL)
+
+
+def round_trip(index: ChunkIndex, dtype: str = "float32") -> ChunkIndex:
+    return ChunkIndex.from_buffer(np.frombuffer(index.to_bytes(dtype), dtype=np.uint8), EMBEDDINGS_MODEL)
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float32", 0), ("float16", 1e-3)])
+def test_round_trip(dtype, tolerance):
+    index = make_index({"a.pdf": range(1, 151), "b.pdf": [3, 1, 2]})
+    loaded = round_trip(index, dtype)
+    assert loaded.embeddings.dtype == np.dtype(dtype)
+    np.testing.assert_allclose(loaded.embeddings, index.embeddings, atol=tolerance)
+    np.testing.assert_array_equal(loaded.norms, index.norms)
+    np.testing.assert_array_equal(loaded.page_numbers, index.page_numbers)
+    assert loaded.sources == index.sources
+    assert loaded.texts(range(len(index))) == index.texts(range(len(index)))
+    query = np.random.default_rng(1).normal(size=index.dimension)
+    np.testing.assert_array_equal(loaded.search(query, 5)[0], index.search(query, 5)[0])
+
+
+def test_round_trip_keeps_quantization_and_occurrences():
+    index = make_index({"a.pdf": [1, 2], "b.pdf": [5]})
+    representatives = np.array([0, 1, 0])
+    index = index.deduplicated(representatives)
+    index.quantize()
+    loaded = round_trip(index)
+    np.testing.assert_array_equal(loaded.quantized.codes, index.quantized.codes)
+    assert loaded.metadata(range(len(loaded))) == index.metadata(range(len(index)))
+
+
+def test_deduplicated_keeps_every_citation():
+    rng = np.random.default_rng(0)
+    shared = rng.normal(size=16)
+    records = [
+        {"text": "Shared clause", "embeddings": shared, "page_number": 1, "source": "a.pdf"},
+        {"text": "Own text of a", "embeddings": rng.normal(size=16), "page_number": 1, "source": "a.pdf"},
+        {"text": "Shared clause", "embeddings": shared, "page_number": 1, "source": "a.pdf"},
+        {"text": "Shared  clause.", "embeddings": shared, "page_number": 4, "source": "b.pdf"},
+        {"text": "Shared clause", "embeddings": shared, "page_number": 7, "source": "c.pdf"},
+    ]
+    index = ChunkIndex.from_records(records, EMBEDDINGS_MODEL)
+    deduplicated = index.deduplicated(find_duplicates(index.texts(range(len(index))), index.embeddings, 0.98))
+    assert deduplicated.texts(range(len(deduplicated))) == ["Shared clause", "Own text of a"]
+    # The repetition on the same page of a.pdf is cited once
+    assert deduplicated.metadata([0]) == [
+        {
+            "page_number": 1,
+            "source": "a.pdf",
+            "occurrences": [{"page_number": 4, "source": "b.pdf"}, {"page_number": 7, "source": "c.pdf"}],
+        }
+    ]
+    assert deduplicated.metadata([1])[0]["occurrences"] == []
+
+
+def test_source_runs():
+    index = make_index({"a.pdf": [1, 2, 3], "b.pdf": [4, 2], "c.pdf": [1]})
+    starts, stops, source_ids, ascending = index.source_runs
+    np.testing.assert_array_equal(starts, [0, 3, 5])
+    np.testing.assert_array_equal(stops, [3, 5, 6])
+    assert [index.sources[source_id] for source_id in source_ids] == ["a.pdf", "b.pdf", "c.pdf"]
+    np.testing.assert_array_equal(ascending, [True, False, True])
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_filter_rows(shuffle):
+    index = make_index({"a.pdf": range(1, 41), "b.pdf": list(range(40, 0, -1)), "c.pdf": range(1, 41)})
+    if shuffle:
+        # Rows in IVF list order are scattered over many short runs
+        index = index.select(np.random.default_rng(0).permutation(len(index)))
+    pages, sources = index.page_numbers, np.array(index.sources)[index.source_ids]
+    assert index.filter_rows() is None
+    for selected, first_page, last_page in [(["a.pdf"], None, None), (["b.pdf", "c.pdf"], 5, 9), ([], 38, None)]:
+        expected = np.isin(sources, selected or index.sources)
+        expected &= (pages >= (first_page or 0)) & (pages <= (last_page or np.inf))
+        np.testing.assert_array_equal(index.filter_rows(selected, first_page, last_page), np.flatnonzero(expected))
+
+
+def test_filter_rows_includes_occurrences():
+    index = make_index({"a.pdf": [1, 2], "b.pdf": [5]}).deduplicated(np.array([0, 1, 0]))
+    np.testing.assert_array_equal(index.filter_rows(["b.pdf"]), [0])
+    np.testing.assert_array_equal(index.filter_rows(["a.pdf"], 2, 2), [1])
+
+
+def test_empty_index():
+    index = round_trip(ChunkIndex.from_records([], EMBEDDINGS_MODEL))
+    assert len(index) == 0
+    rows, distances = index.search(np.ones(16), 5)
+    assert len(rows) == len(distances) == 0
+    assert len(index.search_many(np.ones((2, 16)), 5)[0][0]) == 0
+    assert len(index.filter_rows(["a.pdf"])) == 0
@@ -0,0 +1,145 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from viktor import UserError
+
+from app.AI_search import project_index
+from app.AI_search.config import EMBEDDINGS_MODEL
+from app.AI_search.index_storage import ChunkIndex
+from app.project.controller import Controller
+from benchmarks.local_platform import LocalPlatform
+
+
+@pytest.fixture
+def platform(monkeypatch):
+    platform = LocalPlatform()
+    monkeypatch.setattr(project_index, "Storage", platform.storage())
+    return platform
+
+
+@pytest.fixture
+def project(platform):
+    project = platform.create_entity("Project")
+    with platform.as_entity(project):
+        yield project
+
+
+def add_pdf(platform: LocalPlatform, project, name: str, texts: list[str], seed: int = 0):
+    """PDF entity whose processed index holds a chunk per text, one chunk per page"""
+    rng = np.random.default_rng(seed)
+    records = [
+        {"text": text, "embeddings": rng.normal(size=16), "page_number": page, "source": name}
+        for page, text in enumerate(texts, start=1)
+    ]
+    pdf = platform.create_entity(name, parent=project)
+    platform.files[("entity", pdf.id, "pdf_storage")] = ChunkIndex.from_records(records, EMBEDDINGS_MODEL).to_bytes()
+    return pdf
+
+
+def chunk_texts(name: str, n_chunks: int) -> list[str]:
+    return [f"{name} chunk {i}" for i in range(n_chunks)]
+
+
+def loaded_texts() -> dict:
+    index, _ = project_index.load_project_index()
+    texts = {}
+    for row in range(len(index)):
+        texts.setdefault(index.sources[index.source_ids[row]], []).append(index.text(row))
+    return texts
+
+
+def test_add_and_remove_documents(platform, project, monkeypatch):
+    monkeypatch.setattr(project_index, "INDEX_MAX_TOMBSTONE_FRACTION", 1.0)
+    first = add_pdf(platform, project, "a.pdf", chunk_texts("a", 5))
+    second = add_pdf(platform, project, "b.pdf", chunk_texts("b", 3), seed=1)
+    manifest = project_index.update_project_index([first, second])
+    assert project_index.count_chunks(manifest) == 8
+    assert loaded_texts() == {"a.pdf": chunk_texts("a", 5), "b.pdf": chunk_texts("b", 3)}
+
+    manifest = project_index.update_project_index([second])
+    [segment] = manifest["segments"].values()
+    assert segment["tombstones"] == [[0, 5]]
+    assert [document["name"] for document in manifest["documents"]] == ["b.pdf"]
+    assert project_index.count_chunks(manifest) == 3
+    assert loaded_texts() == {"b.pdf": chunk_texts("b", 3)}
+
+
+def test_replaced_document_is_read_again(platform, project):
+    pdf = add_pdf(platform, project, "a.pdf", chunk_texts("a", 4))
+    project_index.update_project_index([pdf])
+    platform.files[("entity", pdf.id, "pdf_version")] = b'{"document_hash": "v2"}'
+    platform.files[("entity", pdf.id, "pdf_storage")] = ChunkIndex.from_records(
+        [{"text": "new text", "embeddings": np.ones(16), "page_number": 1, "source": "a.pdf"}], EMBEDDINGS_MODEL
+    ).to_bytes()
+    manifest = project_index.update_project_index([pdf])
+    assert project_index.count_chunks(manifest) == 1
+    assert loaded_texts() == {"a.pdf": ["new text"]}
+
+
+def test_compaction(platform, project, monkeypatch):
+    monkeypatch.setattr(project_index, "INDEX_MAX_SEGMENTS", 1)
+    first = add_pdf(platform, project, "a.pdf", chunk_texts("a", 5))
+    second = add_pdf(platform, project, "b.pdf", chunk_texts("b", 3), seed=1)
+    third = add_pdf(platform, project, "c.pdf", chunk_texts("c", 2), seed=2)
+    project_index.update_project_index([first, second])
+    manifest = project_index.update_project_index([second, third])
+    [(segment_key, segment)] = manifest["segments"].items()
+    assert segment == {"count": 5, "tombstones": [], "ann": False}
+    assert {(document["name"], document["start"], document["stop"]) for document in manifest["documents"]} == {
+        ("b.pdf", 0, 3),
+        ("c.pdf", 3, 5),
+    }
+    stored_segments = {key for (_, _, key) in platform.files if key.startswith(project_index.SEGMENT_KEY_PREFIX)}
+    assert stored_segments == {segment_key, f"{segment_key}_bm25"}
+    assert loaded_texts() == {"b.pdf": chunk_texts("b", 3), "c.pdf": chunk_texts("c", 2)}
+
+
+def test_shared_chunks_keep_every_citation(platform, project):
+    first = add_pdf(platform, project, "a.pdf", ["Shared clause", "Only in a"])
+    second = add_pdf(platform, project, "b.pdf", ["Only in b", "Shared clause"], seed=1)
+    manifest = project_index.update_project_index([first, second])
+    assert project_index.count_chunks(manifest) == 3
+    assert [document.get("duplicates_with") for document in manifest["documents"]] == [[second.id], [first.id]]
+    index, _ = project_index.load_project_index()
+    [shared] = [row for row in range(len(index)) if index.text(row) == "Shared clause"]
+    assert index.metadata([shared])[0]["occurrences"] == [{"page_number": 2, "source": "b.pdf"}]
+
+    # Removing the document that holds the shared chunk keeps it, cited by the remaining document only
+    manifest = project_index.update_project_index([second])
+    index, _ = project_index.load_project_index()
+    assert sorted(index.texts(range(len(index)))) == ["Only in b", "Shared clause"]
+    assert index.metadata(range(len(index))) == [
+        {"page_number": page, "source": "b.pdf", "occurrences": []} for page in index.page_numbers
+    ]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_ann_segment_is_stored_in_list_order(platform, project, monkeypatch, compact):
+    monkeypatch.setattr(project_index, "ANN_MIN_CHUNKS", 30)
+    monkeypatch.setattr(project_index, "INDEX_MAX_TOMBSTONE_FRACTION", 0.25 if compact else 1.0)
+    first = add_pdf(platform, project, "a.pdf", chunk_texts("a", 60))
+    second = add_pdf(platform, project, "b.pdf", chunk_texts("b", 40), seed=1)
+    manifest = project_index.update_project_index([first, second])
+    assert all(segment["ann"] for segment in manifest["segments"].values())
+    manifest = project_index.update_project_index([second])
+    assert [bool(segment["tombstones"]) for segment in manifest["segments"].values()] == [not compact]
+    assert all(segment["ann"] for segment in manifest["segments"].values())
+    index, _ = project_index.load_project_index()
+    assert sorted(index.texts(range(len(index)))) == sorted(chunk_texts("b", 40))
+    query = np.random.default_rng(2).normal(size=16)
+    np.testing.assert_array_equal(index.search(query, 10, probe_fraction=1.0)[0], index.engine.search(query, 10)[0])
+    order = np.argsort(index.positions)
+    assert index.texts(order) == chunk_texts("b", 40)
+
+
+def test_empty_index(platform, project):
+    pdf = add_pdf(platform, project, "scanned.pdf", [])
+    manifest = project_index.update_project_index([pdf])
+    assert project_index.count_chunks(manifest) == 0
+    index, _ = project_index.load_project_index()
+    assert len(index) == 0
+    assert len(index.search(np.ones(16), 5)[0]) == 0
+    params = SimpleNamespace(input=SimpleNamespace(documents=None, first_page=None, last_page=None))
+    with pytest.raises(UserError):
+        Controller._search_filter(params, index)